@@ -0,0 +1,57 @@
+# Network benchmark: per-link memory and build time of the array-backed
+# core (array_core.ArrayCore) against plain LossyCostLink objects, on a
+# random geometric topology of a given size.
+#
+# Usage: python benchmarks/network_bench.py [numnodes]
+
+import os, sys, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dependency'))
+import numpy as np
+from set_up import RouterNetwork
+from array_core import ArrayCore, LINK_ARRAYS
+
+class ArrayRouterNetwork(ArrayCore, RouterNetwork):
+    pass
+
+# nodes on a sqrt(n) x sqrt(n) grid of random spots, linked within range 2
+def topology(numnodes):
+    side = int(np.sqrt(numnodes)) * 2
+    spots = random.Random(1).sample(xrange(side*side), numnodes)
+    nodes = [('N%d' % i, s % side, s // side) for i, s in enumerate(spots)]
+    where = dict(((x, y), a) for a, x, y in nodes)
+    links = []
+    for a, x, y in nodes:
+        for dx, dy in ((1, 0), (0, 1), (1, 1), (1, -1), (2, 0), (0, 2)):
+            b = where.get((x + dx, y + dy))
+            if b is not None: links.append((a, b))
+    return nodes, links
+
+# bytes owned by one link (packet queues included, nodes excluded)
+def footprint(net):
+    link = net.links[0]
+    size = sys.getsizeof(link)
+    if hasattr(link, '__dict__'): size += sys.getsizeof(link.__dict__)
+    for q in (link.q12, link.q21):
+        if q is not None: size += sys.getsizeof(q)
+    if isinstance(net, ArrayCore):
+        size += sum(getattr(net, name).itemsize *
+                    int(np.prod(getattr(net, name).shape[1:]))
+                    for name in LINK_ARRAYS)
+    return size
+
+def report(numnodes):
+    (nodes, links) = topology(numnodes)
+    print '%d nodes, %d links' % (len(nodes), len(links))
+    for name, cls in (('LossyCostLink', RouterNetwork),
+                      ('ArrayCore', ArrayRouterNetwork)):
+        start = time.time()
+        net = cls(1000, nodes, links, 0.1)
+        secs = time.time() - start
+        print '  %-13s %4d bytes/link  %6.2f s to build' % \
+              (name, footprint(net), secs)
+
+if __name__ == '__main__':
+    n = 20000
+    if len(sys.argv) > 1: n = int(sys.argv[1])
+    report(n)
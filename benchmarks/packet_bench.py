@@ -0,0 +1,77 @@
+# Packet benchmark: per-packet memory and construction time of the
+# compact (__slots__, shared property template, lazy route) Packet
+# against the original dict-based representation.
+#
+# Usage: python benchmarks/packet_bench.py [npackets]
+
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'dependency'))
+from bottomLayer import Packet, share_properties
+
+# the Packet class as it was before it was made compact
+class DictPacket:
+    def __init__(self,src,dest,type,start,**props):
+        self.source = src
+        self.destination = dest
+        self.type = type
+        self.start = start
+        self.finish = None
+        self.route = []
+        self.network = None
+        self.properties = props.copy()
+
+# bytes owned by one packet (shared templates are not counted)
+def footprint(p):
+    size = sys.getsizeof(p)
+    if hasattr(p, '__dict__'): size += sys.getsizeof(p.__dict__)
+    if getattr(p, 'hops', 0) is not None:
+        size += sys.getsizeof(p.route)
+    props = p.properties
+    if type(props) is dict: size += sys.getsizeof(props)
+    return size
+
+def hello(cls, t):
+    return cls('A', 'B', 'HELLO', t, color='green')
+
+def advert(cls, t):
+    return cls('A', 'B', 'ADVERT', t, color='red', ad=('A', 3))
+
+# a packet as Network.make_packet makes it, sharing its type's template
+def shared(cls, make, t, templates):
+    p = make(cls, t)
+    share_properties(p, templates)
+    return p
+
+def construct(make, cls, n):
+    if cls is DictPacket:
+        for t in xrange(n):
+            make(cls, t)
+    else:
+        templates = {}
+        for t in xrange(n):
+            share_properties(make(cls, t), templates)
+
+# Repeats of the two classes are interleaved and the best kept, so a
+# slow spell of the machine hits both alike.
+def report(n, repeat=15):
+    classes = (('dict Packet', DictPacket), ('slots Packet', Packet))
+    for make in (hello, advert):
+        print '%d %s packets' % (n, make.__name__.upper())
+        best = [None]*len(classes)
+        for r in range(repeat):
+            for i, (name, cls) in enumerate(classes):
+                secs = timeit.timeit(lambda: construct(make, cls, n), number=1)
+                best[i] = min(secs, best[i] or secs)
+        templates = {}
+        shared(Packet, make, 0, templates)
+        sizes = (footprint(make(DictPacket, 0)),
+                 footprint(shared(Packet, make, 1, templates)))
+        for (name, cls), secs, size in zip(classes, best, sizes):
+            print '  %-13s %4d bytes/packet  %6.3f us/packet' % \
+                  (name, size, 1e6*secs/n)
+
+if __name__ == '__main__':
+    n = 100000
+    if len(sys.argv) > 1: n = int(sys.argv[1])
+    report(n)
@@ -0,0 +1,253 @@
+# Array-backed network core for large simulations.
+#
+# ArrayCore is mixed in ahead of a RouterNetwork subclass:
+#
+#     class BigTreeNetwork(ArrayCore, TreeRouterNetwork): pass
+#
+# It keeps the per-link data that a Link object would hold in a __dict__
+# (endpoints, cost, loss probability, loss/tail-drop counters, broken
+# flag, queue lengths) in NumPy arrays indexed by link number, and node
+# positions in an (N, 2) array indexed by node number.  Protocol code
+# still sees Node objects and Link-like ArrayLink views with the usual
+# send/receive/queue_length/cost API, so routers work unchanged and
+# produce the same traces; an ArrayLink is a __slots__ object holding its
+# index, its two end nodes and packet deques that are only allocated once
+# something is sent each way.
+#
+# ArrayCore.node_index[n]       -- row of node n in positions
+# ArrayCore.link_cost[i] etc.   -- per-link arrays (see LINK_ARRAYS)
+# ArrayCore.positions()         -- (N, 2) node positions
+# ArrayCore.link_ends()         -- (L, 2) node rows of each link's ends
+# ArrayCore.adjacency()         -- CSR (indptr, link ids, neighbor rows)
+# ArrayCore.backlog()           -- packets queued on each node's out-links
+# ArrayCore.relink(link)        -- link now joins other nodes
+# ArrayCore.move_node(n,x,y)    -- as Network.move_node, keeping positions
+
+import random, math, inspect
+import numpy as np
+from collections import deque
+from bottomLayer import SampledLoss
+
+
+# return arr with room for at least n rows, doubling its capacity
+def grow(arr, n):
+    if n <= len(arr): return arr
+    bigger = np.zeros((max(n, 2*len(arr), 16),) + arr.shape[1:], arr.dtype)
+    bigger[:len(arr)] = arr
+    return bigger
+
+
+class ArrayLink(SampledLoss):
+    __slots__ = ('network', 'index', 'end1', 'end2', 'q12', 'q21',
+                 'sampler', 'next_loss')
+
+    def __init__(self, network, index, n1, n2):
+        self.network = network
+        self.index = index
+        self.end1 = n1      # node at one end of the link
+        self.end2 = n2      # node at the other end
+        self.q12 = None     # deque of packets to end2, made on first send
+        self.q21 = None     # deque of packets to end1, made on first send
+        self.sampler = None     # loss_model sampler, if any
+        self.next_loss = None
+        n1.add_link(self)
+        n2.add_link(self)
+
+    def __repr__(self):
+        return 'link(%s<-->%s) (%.1f)' % (self.end1, self.end2, self.cost)
+
+    # per-link values live in the network's arrays
+    def get_cost(self): return float(self.network.link_cost[self.index])
+    def set_cost(self, cost): self.network.link_cost[self.index] = cost
+    cost = property(get_cost, set_cost)
+
+    @property
+    def costrepr(self):
+        cost = self.cost
+        if int(cost) == cost: return str(cost)
+        return "sqrt(" + str(cost*cost) + ")"
+
+    def get_lossprob(self): return float(self.network.link_lossprob[self.index])
+    def set_lossprob(self, p): self.network.link_lossprob[self.index] = p
+    lossprob = property(get_lossprob, set_lossprob)
+
+    def get_broken(self): return bool(self.network.link_broken[self.index])
+    def set_broken(self, b): self.network.link_broken[self.index] = b
+    broken = property(get_broken, set_broken)
+
+    @property
+    def linkloss(self): return int(self.network.link_linkloss[self.index])
+
+    @property
+    def taildrop(self): return int(self.network.link_taildrop[self.index])
+
+    @property
+    def capacity(self): return getattr(self.network, 'link_capacity', None)
+
+    def reset(self):
+        self.q12 = None
+        self.q21 = None
+        self.network.link_qlen[self.index] = 0
+        self.network.link_taildrop[self.index] = 0
+
+    # return count of undelivered packets sent by specified node
+    def queue_length(self, n):
+        if n is self.end1: q = self.q12
+        elif n is self.end2: q = self.q21
+        else: raise Exception, 'bad node in ArrayLink.queue_length'
+        if q is None: return 0
+        return len(q)
+
+    # return (link, packet) destined for specified node (or None)
+    def receive(self, n):
+        if n is self.end1: (q, side) = (self.q21, 1)
+        elif n is self.end2: (q, side) = (self.q12, 0)
+        else: raise Exception, 'bad node in ArrayLink.receive'
+        if not q: return None
+        self.network.link_qlen[self.index, side] -= 1
+        return (self, q.popleft())
+
+    # send one packet from specified node, losing it with probability
+    # lossprob (or as the sampler says) exactly as LossyCostLink does
+    def send(self, n, p):
+        net = self.network
+        i = self.index
+        if self.sampler is None:
+            delivered = random.random() > net.link_lossprob[i]
+        else:
+            try: delivered = not self.next_loss()
+            except StopIteration: delivered = not self.refill_losses()
+        if delivered:
+            if net.link_broken[i]:
+                self.dropped(p)
+                return
+            if n is self.end1:
+                side = 0
+                if self.q12 is None: self.q12 = deque()
+                q = self.q12
+            elif n is self.end2:
+                side = 1
+                if self.q21 is None: self.q21 = deque()
+                q = self.q21
+            else: raise Exception, 'bad node in ArrayLink.send'
+            capacity = getattr(net, 'link_capacity', None)
+            if capacity is not None and len(q) >= capacity:
+                net.link_taildrop[i] += 1   # queue full, drop the newcomer
+                self.dropped(p)
+            else:
+                q.append(p)
+                net.link_qlen[i, side] += 1
+        else:
+            net.link_linkloss[i] += 1   # stats on number of losses
+            self.dropped(p)
+
+    # tell packet tracers that p never made it onto the link, then hand
+    # it back to the network's packet pool (net_sim networks have neither)
+    def dropped(self, p):
+        net = self.network
+        if getattr(net, 'listeners', None): net.packet_event('dropped', p)
+        if hasattr(net, 'release_packet'): net.release_packet(p)
+
+
+# per-link arrays, all indexed by link number
+LINK_ARRAYS = ('link_end', 'link_cost', 'link_lossprob', 'link_broken',
+               'link_linkloss', 'link_taildrop', 'link_qlen')
+
+
+class ArrayCore:
+    # RouterNetwork.__init__ adds nodes and links one at a time, so the
+    # arrays start out empty (these shared zero-length ones are replaced,
+    # never written, on the first make_link) and grow by doubling.  Nodes
+    # get their rows the first time a link or query needs them, in nlist
+    # order.
+    node_index = None
+    xy = np.zeros((0, 2))
+    csr = None
+    link_end = np.zeros((0, 2), np.int32)
+    link_cost = np.zeros(0)
+    link_lossprob = np.zeros(0)
+    link_broken = np.zeros(0, bool)
+    link_linkloss = np.zeros(0, np.int64)
+    link_taildrop = np.zeros(0, np.int64)
+    link_qlen = np.zeros((0, 2), np.int32)
+
+    def index_nodes(self):
+        if self.node_index is None: self.node_index = {}
+        count = len(self.node_index)
+        if count < len(self.nlist):
+            self.xy = grow(self.xy, len(self.nlist))
+            for n in self.nlist[count:]:
+                self.xy[count] = n.location
+                self.node_index[n] = count
+                count += 1
+
+    # Network.move_node of the class ArrayCore is mixed into.  It is
+    # looked up rather than named: set_up is imported both as a top-level
+    # module and as dependency.set_up, so set_up.Network need not be the
+    # class this network is built on.
+    def move_node(self, n, x, y):
+        mro = inspect.getmro(self.__class__)
+        for cls in mro[mro.index(ArrayCore) + 1:]:
+            if 'move_node' in cls.__dict__:
+                cls.__dict__['move_node'](self, n, x, y)
+                break
+        if self.node_index is not None and n in self.node_index:
+            self.xy[self.node_index[n]] = (x, y)
+
+    def make_link(self, n1, n2):
+        self.index_nodes()
+        i = len(self.links)
+        for name in LINK_ARRAYS:
+            setattr(self, name, grow(getattr(self, name), i + 1))
+        self.link_end[i] = (self.node_index[n1], self.node_index[n2])
+        (loc1, loc2) = (n1.location, n2.location)
+        dx2 = (loc1[0] - loc2[0])*(loc1[0] - loc2[0])
+        dy2 = (loc1[1] - loc2[1])*(loc1[1] - loc2[1])
+        self.link_cost[i] = math.sqrt(dx2 + dy2)
+        self.link_lossprob[i] = getattr(self, 'lossprob', 0)
+        self.csr = None
+        return ArrayLink(self, i, n1, n2)
+
+    # mobility.py re-attaches detached links between other nodes, as
+    # fresh links
+    def relink(self, link):
+        i = link.index
+        self.link_end[i] = (self.node_index[link.end1],
+                            self.node_index[link.end2])
+        self.link_linkloss[i] = 0
+        self.link_taildrop[i] = 0
+        self.csr = None
+
+    def positions(self):
+        self.index_nodes()
+        return self.xy[:len(self.nlist)]
+
+    def link_ends(self):
+        return self.link_end[:len(self.links)]
+
+    # CSR adjacency over nodes: the links of node row i are
+    # link_ids[indptr[i]:indptr[i+1]], leading to neighbor rows nbrs[...]
+    def adjacency(self):
+        self.index_nodes()
+        if self.csr is None:
+            ends = self.link_ends()
+            ids = np.arange(len(ends), dtype=np.int32)
+            src = np.concatenate((ends[:, 0], ends[:, 1]))
+            dst = np.concatenate((ends[:, 1], ends[:, 0]))
+            lid = np.concatenate((ids, ids))
+            order = np.argsort(src, kind='mergesort')
+            counts = np.bincount(src, minlength=len(self.nlist))
+            indptr = np.zeros(len(self.nlist) + 1, np.int64)
+            np.cumsum(counts, out=indptr[1:])
+            self.csr = (indptr, lid[order], dst[order])
+        return self.csr
+
+    # number of packets each node (by row) has queued on its out-links
+    def backlog(self):
+        self.index_nodes()
+        ends = self.link_ends()
+        qlen = self.link_qlen[:len(ends)]
+        return np.bincount(ends[:, 0], weights=qlen[:, 0],
+                           minlength=len(self.nlist)) + \
+               np.bincount(ends[:, 1], weights=qlen[:, 1],
+                           minlength=len(self.nlist))
@@ -1,7 +1,8 @@
 # Network simulator for routing and transport protocols,
 # This file defines basic objects to establish a network: 1. Node 2. Link 3. Packet
 
-import random, sys, wx, math
+import random, sys, wx, math, heapq
+from collections import deque
 
 ################################################################################
 #
@@ -11,8 +12,11 @@ import random, sys, wx, math
 # Node.add_packet(p)  -- add packet to node's transmit queue
 # Node.receive(p)     -- called to process packet sent to this node
 # Node.transmit(time) -- allow node to send packets at current time
+# Node.next_wakeup(t) -- earliest time >= t at which transmit has work
 # Node.forward(p)     -- lookup route for pkt p and send it on appropriate link
 # Node.arrived_on(p)  -- returns link that packet p just arrived on
+# Node.add_link(l)    -- note that link l connects to this node
+# Node.remove_link(l) -- forget link l
 #
 ################################################################################
 
@@ -23,7 +27,7 @@ class Node:
         else: self.address = address
         self.links = []  # links that connect to this node
         self.packets = []  # packets to be processed this timestep
-        self.transmit_queue = []  # packets to be transmitted from this node
+        self.transmit_queue = TransmitQueue()  # packets to be transmitted from this node
         self.receive_queue = []  # packets received by this node
         self.properties = {}
         self.network = None  # will be filled in later
@@ -35,7 +39,7 @@ class Node:
     # reset to initial state
     def reset(self):
         for l in self.links: l.reset()
-        self.transmit_queue = []   # nothing to transmit
+        self.transmit_queue = TransmitQueue()   # nothing to transmit
         self.receive_queue = []    # nothing received
         self.queue_length_sum = 0  # reset queue statistics
         self.queue_length_max = 0
@@ -48,16 +52,15 @@ class Node:
     def add_link(self,l):
         self.links.append(l)
 
+    def remove_link(self,l):
+        self.links.remove(l)
+
     # add a packet to be transmitted from this node.  Transmit queue
     # is kept ordered by packet start time.
     def add_packet(self,p):
-        index = 0
-        for pp in self.transmit_queue:
-            if p.start < pp.start:
-                self.transmit_queue.insert(index,p)
-                break
-            else: index += 1
-        else: self.transmit_queue.append(p)
+        self.transmit_queue.push(p)
+        # let an event-driven network know this node has a packet start
+        if self.network is not None: self.network.packet_queued(self,p)
 
     # first phase of simulation timestep: collect one packet from
     # each incoming link
@@ -96,10 +99,19 @@ class Node:
     def transmit(self,time):
         # look for packets on this node's transmit queue whose time has come
         while len(self.transmit_queue) > 0:
-            if self.transmit_queue[0].start <= time:
-                self.process(self.transmit_queue.pop(0),None,time)
+            if self.transmit_queue.head().start <= time:
+                self.process(self.transmit_queue.pop(),None,time)
             else: break
 
+    # earliest simulation time >= time at which transmit() may have
+    # something to do, or None if it never will.  Used by the
+    # event-driven scheduler to skip idle ticks; OVERRIDE together with
+    # transmit().
+    def next_wakeup(self,time):
+        if len(self.transmit_queue) > 0:
+            return max(time,int(math.ceil(self.transmit_queue.head().start)))
+        return None
+
     # OVERRIDE: forward packet onto proper outgoing link.  Default behavior
     # is to pick a link at random!
     def forward(self,p):
@@ -111,6 +123,8 @@ class Node:
         if p.destination == self.address:
             # it's for us!  Just note time of arrival and pass it receive
             p.finish = time
+            if self.network is not None and self.network.listeners:
+                self.network.packet_event('received',p)
             self.receive(p,link)
         else:
             p.add_hop(self,time)
@@ -134,7 +148,7 @@ class Node:
         dc.DrawText(label,loc[0]+self.nsize+2,loc[1]+self.nsize+2)
 
         if len(self.transmit_queue) > 0:
-            self.transmit_queue[0].draw(dc,transform,
+            self.transmit_queue.head().draw(dc,transform,
                                         loc[0]-2*self.nsize,loc[1]-2*self.nsize)
 
     # if pos is near us, return status string
@@ -145,7 +159,7 @@ class Node:
             return self.status()
         elif len(self.transmit_queue) > 0:
             if (dx > .1 and dx < .2) and (dy > .1 and dy < .2):
-                return 'Unsent '+self.transmit_queue[0].status()
+                return 'Unsent '+self.transmit_queue.head().status()
         else:
             return None
 
@@ -173,14 +187,21 @@ class Node:
 # Link.other_end(n)    -- return node at other end of link
 # Link.receive(n)      -- return one packet destined for specified node (or None)
 # Link.send(n,p)       -- send packet to other end of link
+# Link.dropped(p)      -- report a packet lost on this link
+#
+# Each direction is a FIFO deque, so send and receive are O(1).  If
+# capacity is given, a send onto a full direction is tail-dropped and
+# counted in Link.taildrop.
 #
 ################################################################################
 class Link:
-    def __init__(self,n1,n2):
+    def __init__(self,n1,n2,capacity=None):
         self.end1 = n1   # node at one end of the link
         self.end2 = n2   # node at the other end
-        self.q12 = []    # queue of packets to be delivered to end2
-        self.q21 = []    # queue of packets to be delivered to end1
+        self.q12 = deque()   # queue of packets to be delivered to end2
+        self.q21 = deque()   # queue of packets to be delivered to end1
+        self.capacity = capacity  # max packets per direction (None = no limit)
+        self.taildrop = 0    # number of pkts dropped on a full queue
         self.cost = 1    # by default, cost is 1
         self.costrepr = str(self.cost) # representing cost in GUI
         self.network = None  # will be filled in later
@@ -192,8 +213,9 @@ class Link:
         return 'link(%s<-->%s) (%.1f)' % (self.end1,self.end2, self.cost)
 
     def reset(self):
-        self.q12 = []    # reset packet queues
-        self.q21 = []
+        self.q12 = deque()   # reset packet queues
+        self.q21 = deque()
+        self.taildrop = 0
 
     # return count of undelivered packets sent by specified node
     def queue_length(self,n):
@@ -204,27 +226,40 @@ class Link:
     # return (link, packet) destined for specified node (or None)
     def receive(self,n):
         if n == self.end1:
-            if len(self.q21) > 0: return (self, self.q21.pop(0))
+            if len(self.q21) > 0: return (self, self.q21.popleft())
             else: return None
         elif n == self.end2:
-            if len(self.q12): return (self, self.q12.pop(0))
+            if len(self.q12): return (self, self.q12.popleft())
             else: return None
         else: raise Exception,'bad node in Link.receive'
 
     # send one packet from specified node
     def send(self,n,p):
-        if self.broken: return
-        if n == self.end1: self.q12.append(p)
-        elif n == self.end2: self.q21.append(p)
+        if self.broken:
+            self.dropped(p)
+            return
+        if n == self.end1: q = self.q12
+        elif n == self.end2: q = self.q21
         else: raise Exception,'bad node in Link.send'
+        if self.capacity is not None and len(q) >= self.capacity:
+            self.taildrop += 1   # queue full, drop the newcomer
+            self.dropped(p)
+        else: q.append(p)
+
+    # tell packet tracers that p never made it onto the link, then hand
+    # it back to the network's packet pool
+    def dropped(self,p):
+        if self.network is not None:
+            if self.network.listeners: self.network.packet_event('dropped',p)
+            self.network.release_packet(p)
 
 ######################################################################
 """A link with cost (higher cost means worse link)
 """
 ######################################################################
 class CostLink(Link):
-    def __init__(self,n1,n2):
-        Link.__init__(self,n1,n2)
+    def __init__(self,n1,n2,capacity=None):
+        Link.__init__(self,n1,n2,capacity=capacity)
         self.nsize = 0                # filled in by draw method
         loc1 = n1.location
         loc2 = n2.location
@@ -241,18 +276,44 @@ class CostLink(Link):
     def set_cost(self, cost):
         self.cost = cost
 
-class LossyCostLink(CostLink):
-    def __init__(self,n1,n2,lossprob):
-        CostLink.__init__(self,n1,n2)
+# Loss decisions taken from a loss_model sampler (see loss_model.py), a
+# block at a time, instead of one random.random() call per packet.
+# Mixed into LossyCostLink and array_core.ArrayLink, which start with
+# sampler = None.  next_loss is the bound next() of an iterator over the
+# current block; send() calls it inline and refills on StopIteration.
+# Empty __slots__ so ArrayLink keeps its own.
+class SampledLoss(object):
+    __slots__ = ()
+
+    def set_sampler(self,sampler):
+        self.sampler = sampler
+        self.next_loss = iter(()).next  # its pending loss decisions
+        self.lossprob = sampler.lossprob
+
+    # draw the next block of loss decisions and return the first
+    def refill_losses(self):
+        self.next_loss = iter(self.sampler.block().tolist()).next
+        return self.next_loss()
+
+class LossyCostLink(CostLink,SampledLoss):
+    def __init__(self,n1,n2,lossprob,capacity=None):
+        CostLink.__init__(self,n1,n2,capacity=capacity)
         self.lossprob = lossprob
         self.linkloss = 0       # number of pkts lost on link
+        self.sampler = None     # loss_model sampler, if any
+        self.next_loss = None
 
     def send(self,n,p):
         # we lose packets with probability self.lossprob
-        if random.random() > self.lossprob:
+        if self.sampler is None: delivered = random.random() > self.lossprob
+        else:
+            try: delivered = not self.next_loss()
+            except StopIteration: delivered = not self.refill_losses()
+        if delivered:
             CostLink.send(self,n,p)
         else:
             self.linkloss = self.linkloss + 1 # stats on number of losses
+            self.dropped(p)
 
 ################################################################################
 #
@@ -260,24 +321,64 @@ class LossyCostLink(CostLink):
 #
 # Packet.arrived_from() -- return node this packet just arrived from
 #
+# Packets use __slots__ so they carry no per-instance __dict__.  The route
+# list is only allocated when first used.
+#
+# share_properties(p,templates) -- let p share its type's template
+#
+# Network.make_packet keeps a template per packet type: the first
+# single-property packet of each type in a run (e.g. a HELLO with its
+# color) leaves a read-only copy of its properties, which later packets
+# of that type with equal properties share instead of each keeping its
+# own.  Properties of packets made by a network may therefore be
+# read-only; assign a new dict to p.properties before writing to them.
+#
 ################################################################################
-class Packet:
+
+# read-only dict shared between packets with identical properties
+class PacketProperties(dict):
+    def readonly(self,*args,**kwargs):
+        raise TypeError,'shared packet properties are read-only'
+    __setitem__ = __delitem__ = clear = pop = popitem = readonly
+    setdefault = update = readonly
+
+# templates maps packet type -> PacketProperties
+def share_properties(p,templates):
+    template = templates.get(p.type)
+    if template is None:
+        if len(p.properties) == 1:
+            templates[p.type] = PacketProperties(p.properties)
+    elif template == p.properties:
+        p.properties = template
+
+class Packet(object):
+    __slots__ = ('source','destination','type','start','finish',
+                 'network','hops','properties')
+
     def __init__(self,src,dest,type,start,**props):
         self.source = src     # address of node that originated packet
         self.destination = dest  # address of node that should receive packet
         self.type = type
         self.start = start # simulation time at which packet was transmitted
         self.finish = None # simulation time at which packet was received
-        self.route = []    # list of nodes this packet has visited
+        self.hops = None   # route list, allocated on first use
         self.network = None     # will be filled in later
-        self.properties = props.copy()
+        # **props is already a private dict, so there is nothing to copy
+        self.properties = props
+
+    # list of (node, time) hops this packet has visited
+    @property
+    def route(self):
+        if self.hops is None: self.hops = []
+        return self.hops
 
     def __repr__(self):
         return 'Packet<%s to %s> type %s' % (self.source,self.destination,self.type)
 
     # keep track of where we've been
     def add_hop(self,n,time):
-        self.route.append((n,time))
+        if self.hops is None: self.hops = [(n,time)]
+        else: self.hops.append((n,time))
 
     #########################################################
     # support for graphical simulation interface
@@ -307,3 +408,53 @@ class Packet:
     def status(self):
         return self.__repr__()
 
+# a packet that has been released to its network's pool in debug mode:
+# any further use of it is a bug
+class ReleasedPacket(Packet):
+    __slots__ = ()
+
+    def __getattribute__(self,name):
+        if name == '__class__': return object.__getattribute__(self,name)
+        raise Exception,'packet used after release (%s)' % name
+
+    def __setattr__(self,name,value):
+        raise Exception,'packet used after release (%s)' % name
+
+################################################################################
+#
+# TransmitQueue -- packets waiting to be sent from a node, by start time
+#
+# TransmitQueue.push(p) -- add packet p, O(log n)
+# TransmitQueue.head()  -- packet with the earliest start (or None)
+# TransmitQueue.pop()   -- remove and return the head packet, O(log n)
+#
+# Packets with equal start times come out in the order they were pushed.
+#
+################################################################################
+class TransmitQueue:
+    def __init__(self):
+        self.heap = []   # (start, seq, packet)
+        self.seq = 0     # tie-breaker keeping equal starts FIFO
+
+    def __len__(self):
+        return len(self.heap)
+
+    # packets in transmit order
+    def __iter__(self):
+        return iter([entry[2] for entry in sorted(self.heap)])
+
+    # q[0] is the head packet, as it was when this was a sorted list
+    def __getitem__(self,i):
+        if i == 0 and len(self.heap) > 0: return self.heap[0][2]
+        return list(self)[i]
+
+    def push(self,p):
+        heapq.heappush(self.heap,(p.start,self.seq,p))
+        self.seq += 1
+
+    def head(self):
+        if len(self.heap) > 0: return self.heap[0][2]
+        return None
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
@@ -1,20 +1,58 @@
 ### Distance vector routing
 import random,sys,math
 from optparse import OptionParser
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from net_sim import *
 
 # import p2_tests
 
+# In incremental mode a router only advertises the entries of its cost
+# table that changed since its last advertisement.  Changes are sent as
+# triggered updates at the end of the timestep they happen in, and every
+# FULL_REFRESH-th ADVERT_INTERVAL the whole table is sent so neighbours
+# recover from lost updates.  Advertisements have the same format in
+# both modes, so routes converge to the same costs.
 class DVRouter(Router):
     INFINITY = 32
+    FULL_REFRESH = 5    # ADVERT_INTERVALs between full-table adverts
+
+    def __init__(self, location, address=None, incremental=False):
+        Router.__init__(self, location, address=address)
+        self.incremental = incremental
+        self.changed = set(self.spcost)  # destinations not yet advertised
+        self.nadverts = 0               # periodic adverts sent so far
+        self.adentries = 0              # (dst, cost) entries sent so far
+
+    def reset(self):
+        Router.reset(self)
+        self.changed = set(self.spcost)
+        self.nadverts = 0
+        self.adentries = 0
+
+    def transmit(self, time):
+        Router.transmit(self, time)
+        # triggered update for costs that changed this timestep
+        if self.incremental and self.changed:
+            self.send_dv(self.make_dv_delta(), time)
 
     def send_advertisement(self, time):
-        adv = self.make_dv_advertisement()
+        full = not self.incremental or self.nadverts % self.FULL_REFRESH == 0
+        self.nadverts += 1
+        if full:
+            self.changed.clear()
+            self.send_dv(self.make_dv_advertisement(), time)
+        elif self.changed:
+            self.send_dv(self.make_dv_delta(), time)
+
+    def send_dv(self, adv, time):
         for link in self.links:
             p = self.network.make_packet(self.address, self.peer(link),
                                          'ADVERT', time,
                                          color='red', ad=adv)
             link.send(self, p)
+        self.adentries += len(adv)*len(self.links)
 
     # Make a distance vector protocol advertisement, which will be sent
     # by the caller along all the links
@@ -25,6 +63,15 @@ class DVRouter(Router):
             distance_vector.append((dst,cost))
         return distance_vector
 
+    # Only the entries that changed since the last advertisement
+    def make_dv_delta(self):
+        distance_vector=[]
+        for dst in self.changed:
+            if dst in self.spcost:
+                distance_vector.append((dst,self.spcost[dst]))
+        self.changed.clear()
+        return distance_vector
+
     def link_failed(self, link):
         # If a link is broken, remove it from my routing/cost table
         self.clear_routes(self)
@@ -38,6 +85,7 @@ class DVRouter(Router):
     def integrate(self,link,adv):
         # Loop over all (dst, dst_cost) pairs from the adv
         for dst, dst_cost in adv:
+            old_cost = self.spcost.get(dst)
             # If I don't know dst yet, or the cost to dst thru link is smaller
             if ((not dst in self.spcost) or (link.cost + dst_cost < self.spcost[dst])):
                 # Update the new cost to my cost table
@@ -50,13 +98,65 @@ class DVRouter(Router):
                 self.spcost[dst]=link.cost + dst_cost
                 self.routes[dst]=link
 
+            # remember what to put in the next incremental advert
+            if self.spcost[dst] != old_cost:
+                self.changed.add(dst)
+
 
 
 # A network with nodes of type DVRouter.
+#
+# DVRouterNetwork.converge() fills in every router's routes/spcost with
+# the steady state that ADVERT exchange would eventually reach, using
+# per-source Dijkstra on a CSR adjacency of the link costs.  With
+# warm_start=True, reset() does this, so runs start converged.
 class DVRouterNetwork(RouterNetwork):
+    def __init__(self, SIMTIME, NODES, LINKS, LOSSPROB, incremental=False,
+                 warm_start=False):
+        self.incremental = incremental   # needed by make_node
+        self.warm_start = warm_start
+        RouterNetwork.__init__(self, SIMTIME, NODES, LINKS, LOSSPROB)
+
     # nodes should be an instance of DVNode (defined above)
     def make_node(self,loc,address=None):
-        return DVRouter(loc,address=address)
+        return DVRouter(loc,address=address,incremental=self.incremental)
+
+    def reset(self):
+        RouterNetwork.reset(self)
+        if self.warm_start:
+            self.converge()
+
+    def converge(self):
+        index = dict((n, i) for i, n in enumerate(self.nlist))
+        # cheapest working link between each pair of neighbours
+        best = {}
+        for link in self.links:
+            if link.broken: continue
+            i, j = index[link.end1], index[link.end2]
+            if i == j: continue
+            key = (min(i, j), max(i, j))
+            if key not in best or link.cost < best[key].cost:
+                best[key] = link
+        size = len(self.nlist)
+        rows = np.array([k[0] for k in best], dtype=np.int32)
+        cols = np.array([k[1] for k in best], dtype=np.int32)
+        costs = np.array([best[k].cost for k in best], dtype=float)
+        graph = csr_matrix((costs, (rows, cols)), shape=(size, size))
+        dist, pred = dijkstra(graph, directed=False, return_predecessors=True)
+        # costs are symmetric, so on the tree rooted at destination j,
+        # pred[j, i] is i's next hop towards j
+        for i, n in enumerate(self.nlist):
+            n.routes.clear()
+            n.spcost.clear()
+            n.routes[n.address] = 'Self'
+            n.spcost[n.address] = 0
+            hops = pred[:, i]
+            for j in np.flatnonzero(np.isfinite(dist[:, i])):
+                if j == i: continue
+                hop = int(hops[j])
+                n.routes[self.nlist[j].address] = best[(min(i, hop), max(i, hop))]
+                n.spcost[self.nlist[j].address] = float(dist[j, i])
+            n.changed.clear()    # neighbours already know all of it
 
 ########################################################################
 
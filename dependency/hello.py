@@ -0,0 +1,167 @@
+# Vectorized HELLO / neighbor liveness.
+#
+# With RouterNetwork(...,vector_hello=True) routers stop sending HELLO
+# packets.  A HelloEngine instead keeps, for every directed link (sender
+# -> receiver), the time the receiver last heard a HELLO on it, and on
+# each HELLO tick draws the losses of all HELLOs due at that tick in one
+# Bernoulli batch.  Routers only hear about it when a neighbor times out,
+# through the usual Router.link_failed(link).
+#
+# HelloEngine.tick(time)         -- run the batch for time (idempotent)
+# HelloEngine.stale(n,time)      -- links whose neighbor n has lost
+# HelloEngine.neighbors(n)       -- n's view as a Router.neighbors dict
+# HelloEngine.invalidate()       -- links replaced, rebuild the arrays
+# HelloEngine.forget(link)       -- link was detached or re-attached
+#
+# A HELLO sent at time t is heard at t+1 with probability 1-lossprob and
+# never on a broken link, as a LossyCostLink delivers it when its queue
+# is empty.  Losses are only counted on links that are not broken, so
+# links mobility.py has detached keep clean statistics.  HELLOs no
+# longer queue behind other packets, take queue space or show up in
+# npackets and packet events, so traces differ from per-packet HELLOs
+# while the timeout statistics match.  With a loss_model, HELLOs are
+# lost with each link's long-run lossprob, so bursty models lose their
+# burstiness here.
+
+import numpy as np
+
+
+class HelloEngine:
+    def __init__(self, network):
+        self.network = network
+        self.nlinks = None      # len(network.links) the arrays were built for
+
+    def invalidate(self):
+        self.nlinks = None
+
+    # return to the state after Network.reset(): nobody heard from anyone
+    def reset(self):
+        self.nlinks = None
+        self.build()
+
+    def build(self):
+        net = self.network
+        self.rank = dict((n, i) for i, n in enumerate(net.nlist))
+        self.links = []
+        self.index = {}         # link -> i
+        self.nlinks = 0
+        self.sender = np.zeros(0, np.int64)
+        self.receiver = np.zeros(0, np.int64)
+        self.heard = np.zeros(0, np.int64)  # time last heard
+        self.known = np.zeros(0, bool)      # in receiver's neighbor table
+        self.interval = np.array([n.HELLO_INTERVAL for n in net.nlist],
+                                 np.int64)
+        self.offset = np.array([n.hello_offset for n in net.nlist], np.int64)
+        if hasattr(net, 'link_lossprob'):
+            # array_core.ArrayCore: use the network's live link arrays
+            self.lossprob = None
+        else:
+            self.lossprob = np.zeros(0)
+        self.time = None
+        self.failed = {}        # node rank -> links it has timed out
+        self.extend()
+
+    # Links are only ever appended (see forget), so new ones extend
+    # the arrays and keep what was heard on the old ones.
+    def extend(self):
+        new = self.network.links[self.nlinks:]
+        if not new: return
+        rank = self.rank
+        # directed link d = 2*i + s: s = 0 is end1 -> end2, s = 1 end2 -> end1
+        ends = np.array([(rank[l.end1], rank[l.end2]) for l in new],
+                        np.int64)
+        self.sender = np.concatenate((self.sender, ends.ravel()))
+        self.receiver = np.concatenate((self.receiver, ends[:, ::-1].ravel()))
+        self.heard = np.concatenate((self.heard, np.zeros(2*len(new),
+                                                          np.int64)))
+        self.known = np.concatenate((self.known, np.zeros(2*len(new), bool)))
+        if self.lossprob is not None:
+            self.lossprob = np.concatenate((self.lossprob, [
+                getattr(l, 'lossprob', 0) for l in new]))
+        for l in new:
+            self.index[l] = len(self.links)
+            self.links.append(l)
+        self.nlinks = len(self.links)
+
+    # Mobility detaches links and re-attaches them between other nodes
+    # (see mobility.py): nothing has been heard on link since, from
+    # either end, and its ends may be new.
+    def forget(self, link):
+        if self.nlinks is None: return
+        i = self.index.get(link)
+        if i is None: return    # not seen yet, extend() will pick it up
+        d = slice(2*i, 2*i + 2)
+        (e1, e2) = (self.rank[link.end1], self.rank[link.end2])
+        self.sender[d] = (e1, e2)
+        self.receiver[d] = (e2, e1)
+        self.heard[d] = 0
+        self.known[d] = False
+        if self.lossprob is not None:
+            self.lossprob[i] = getattr(link, 'lossprob', 0)
+
+    def sync(self):
+        nlinks = len(self.network.links)
+        if self.nlinks is None or self.nlinks > nlinks: self.build()
+        elif self.nlinks < nlinks: self.extend()
+
+    def link_state(self):
+        net = self.network
+        if self.lossprob is None:
+            return (net.link_lossprob[:self.nlinks],
+                    net.link_broken[:self.nlinks])
+        broken = np.fromiter((l.broken for l in self.links), bool,
+                             self.nlinks)
+        return self.lossprob, broken
+
+    # Timeouts first, using what was heard up to time, then this tick's
+    # HELLOs, heard at time+1.  Each router's clearStaleHello then picks
+    # up its own timeouts via stale().
+    def tick(self, time):
+        if self.time == time: return
+        self.sync()
+        self.time = time
+        due = (time - self.offset) % self.interval == 0
+
+        hears = due[self.receiver]
+        old = time - 2*self.interval[self.receiver]
+        timeout = np.flatnonzero(hears & self.known & (self.heard <= old))
+        self.known[timeout] = False
+        self.failed = {}
+        for d in timeout:
+            self.failed.setdefault(int(self.receiver[d]), []).append(
+                self.links[d >> 1])
+
+        sends = np.flatnonzero(due[self.sender])
+        if len(sends) == 0: return
+        (lossprob, broken) = self.link_state()
+        link = sends >> 1
+        lost = np.random.random_sample(len(sends)) <= lossprob[link]
+        up = ~broken[link]
+        arrived = sends[~lost & up]
+        self.heard[arrived] = time + 1
+        self.known[arrived] = True
+        # broken links include mobility's detached ones and free slots
+        self.count_losses(link[lost & up])
+
+    # keep the links' linkloss statistics as if the HELLOs had been sent
+    def count_losses(self, lost):
+        if len(lost) == 0: return
+        net = self.network
+        if self.lossprob is None:
+            np.add.at(net.link_linkloss, lost, 1)
+        else:
+            for i in lost: self.links[i].linkloss += 1
+
+    def stale(self, n, time):
+        self.tick(time)
+        return self.failed.pop(self.rank[n], [])
+
+    def neighbors(self, n):
+        self.sync()
+        i = self.rank[n]
+        table = {}
+        for d in np.flatnonzero(self.known & (self.receiver == i)):
+            link = self.links[d >> 1]
+            peer = link.end2 if d & 1 else link.end1
+            table[link] = (int(self.heard[d]), peer.address, link.cost)
+        return table
@@ -0,0 +1,120 @@
+# RSS-driven link quality.
+#
+# LinkQuality(net,threshold,...) derives, for every link of a network,
+# the expected RSS at the link's length from the log-distance model of
+# pass_loss_model, the packet reception rate (PRR) of a receiver with
+# sensitivity threshold dBm, and an ETX cost, the expected number of
+# transmissions for a packet and its acknowledgement to get through
+# (1/PRR^2 on these symmetric links).  All three are NumPy arrays in
+# net.links order.
+#
+# LinkQuality.refresh()        -- recompute every link from node positions
+# LinkQuality.moved(nodes)     -- recompute only the links of moved nodes
+#                                 and any new links
+# LinkQuality.apply(idx=None)  -- set link cost = ETX, lossprob = 1 - PRR
+#
+# Once applied, routing protocols that minimise link cost (DV routing,
+# DVRouterNetwork's warm start) follow the most reliable paths rather
+# than the shortest ones.  TreeRouter picks parents by hop count, so it
+# only sees the new loss probabilities.  Call apply() before reset().
+
+import numpy as np
+from pass_loss_model import PATH_LOSS_N, RSS_REF, SHADOWING_SIGMA, \
+     log_path_mean, reception_probability
+
+MAX_ETX = 1e6       # cost of a link that (practically) never delivers
+
+
+class LinkQuality:
+    def __init__(self, network, threshold, scale=1, n=PATH_LOSS_N,
+                 rss_ref=RSS_REF, sigma=SHADOWING_SIGMA):
+        self.network = network
+        self.threshold = threshold
+        self.scale = scale      # grid distance -> metres
+        self.n = n
+        self.rss_ref = rss_ref
+        self.sigma = sigma
+        network.link_quality = self
+        self.refresh()
+
+    def refresh(self):
+        self.links = []
+        self.index = {}
+        self.rss = np.zeros(0)
+        self.prr = np.zeros(0)
+        self.etx = np.zeros(0)
+        self.extend()
+
+    # compute links appended to net.links since the last call; returns
+    # their indices
+    def extend(self):
+        start = len(self.links)
+        new = self.network.links[start:]
+        for l in new:
+            self.index[l] = len(self.links)
+            self.links.append(l)
+        pad = np.zeros(len(new))
+        self.rss = np.concatenate((self.rss, pad))
+        self.prr = np.concatenate((self.prr, pad))
+        self.etx = np.concatenate((self.etx, pad))
+        idx = np.arange(start, len(self.links))
+        self.update(idx)
+        return idx
+
+    # recompute links idx from their end nodes' current locations
+    def update(self, idx):
+        if len(idx) == 0: return
+        links = self.links
+        xy1 = np.array([links[i].end1.location for i in idx], float)
+        xy2 = np.array([links[i].end2.location for i in idx], float)
+        dist = np.hypot(*(xy1 - xy2).T)*self.scale
+        dist = np.maximum(dist, 1e-9)
+        prr = reception_probability(dist, self.threshold, self.n,
+                                    self.rss_ref, self.sigma)
+        self.rss[idx] = log_path_mean(dist, self.n, self.rss_ref)
+        self.prr[idx] = prr
+        with np.errstate(divide='ignore'):
+            self.etx[idx] = np.minimum(1.0/(prr*prr), MAX_ETX)
+
+    # Only links touching a moved node change, plus any appended to
+    # net.links since the last call.  Returns the indices of the links
+    # recomputed.
+    def moved(self, nodes):
+        if len(self.network.links) < len(self.links):
+            self.refresh()      # links were removed: start over
+            return np.arange(len(self.links))
+        added = self.extend()
+        idx = set()
+        for n in nodes:
+            for l in n.links:
+                idx.add(self.index[l])
+        idx = np.array(sorted(idx.difference(added)), np.int64)
+        self.update(idx)
+        return np.union1d(idx, added)
+
+    # Copy ETX and loss probability of links idx (default all) onto the
+    # links themselves.  Links drawing losses from a loss_model sampler
+    # get a fresh one, since samplers fix their probability when made.
+    def apply(self, idx=None):
+        if idx is None: idx = np.arange(len(self.links))
+        net = self.network
+        if hasattr(net, 'link_cost'):
+            # array_core.ArrayCore: write the network's link arrays
+            net.link_cost[idx] = self.etx[idx]
+            net.link_lossprob[idx] = 1 - self.prr[idx]
+        else:
+            for i in idx:
+                link = self.links[i]
+                link.set_cost(float(self.etx[i]))
+                link.lossprob = 1 - float(self.prr[i])
+        model = getattr(net, 'loss_model', None)
+        if model is not None and net.loss_rng is not None:
+            for i in idx:
+                link = self.links[i]
+                if link.sampler is not None:
+                    link.set_sampler(model.sampler(link, net.loss_rng))
+        engine = getattr(net, 'hello_engine', None)
+        if engine is not None:
+            engine.sync()
+            if engine.lossprob is not None:
+                engine.lossprob[idx] = [self.links[i].lossprob for i in idx]
@@ -0,0 +1,154 @@
+# Link loss models, sampled in bulk.
+#
+# Give a model to RouterNetwork(...,loss_model=m) and at every reset each
+# link gets its own sampler, m.sampler(link,rng).  sampler.block(n)
+# returns the loss decisions (True = lost) for the next n packets the
+# link sends; the link takes them CHUNK at a time, so the RNG runs once
+# per chunk instead of once per packet.  sampler.lossprob is the
+# long-run loss probability, which becomes the link's lossprob.
+#
+# BernoulliLoss(lossprob=None)                    -- independent losses
+# GilbertElliott(p_gb,p_bg,loss_good=0,loss_bad=1) -- bursty, two-state
+# DistanceLoss(threshold,scale=1,...)             -- log-distance RSS
+#
+# Samplers draw from the network's loss_rng, a NumPy RandomState seeded
+# from `random' at reset, so a run stays reproducible under random.seed().
+
+import math
+import numpy as np
+from pass_loss_model import PATH_LOSS_N, RSS_REF, SHADOWING_SIGMA, \
+     log_path_mean, reception_probability
+
+CHUNK = 1024    # loss decisions drawn per refill
+NEVER = 1 << 40 # length of a run in a state that is never left
+
+
+# Each packet is lost independently with probability lossprob, by default
+# the link's own (LossyCostLink's LOSSPROB).
+class BernoulliLoss:
+    def __init__(self, lossprob=None):
+        self.lossprob = lossprob
+
+    def sampler(self, link, rng):
+        if self.lossprob is None: lossprob = link.lossprob
+        else: lossprob = self.lossprob
+        return BernoulliSampler(lossprob, rng)
+
+
+class BernoulliSampler:
+    def __init__(self, lossprob, rng):
+        self.lossprob = lossprob
+        self.rng = rng
+
+    def block(self, n=CHUNK):
+        return self.rng.random_sample(n) < self.lossprob
+
+
+# Gilbert-Elliott channel: a link is either good or bad, and after each
+# packet moves good -> bad with probability p_gb and bad -> good with
+# probability p_bg.  Packets are lost with probability loss_good or
+# loss_bad depending on the state they are sent in.  Links start good.
+class GilbertElliott:
+    def __init__(self, p_gb, p_bg, loss_good=0, loss_bad=1):
+        self.p_gb = p_gb
+        self.p_bg = p_bg
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+
+    def sampler(self, link, rng):
+        return GilbertElliottSampler(self, rng)
+
+
+class GilbertElliottSampler:
+    def __init__(self, model, rng):
+        self.leave = (model.p_gb, model.p_bg)     # state -> P(switch)
+        self.loss = np.array([model.loss_good, model.loss_bad], float)
+        total = model.p_gb + model.p_bg
+        if total > 0: bad = model.p_gb/float(total)
+        else: bad = 0.0
+        self.lossprob = (1 - bad)*model.loss_good + bad*model.loss_bad
+        self.rng = rng
+        self.runs = np.zeros(0, np.int64)   # run lengths, good first
+        self.run = 0        # current run, what is left of it in runs[run]
+
+    # Runs of one state are geometric, so the state sequence is drawn as
+    # run lengths, many per NumPy call.  Runs alternate good, bad, good...
+    # from the first, so run i is in state i & 1.  A block is cut from
+    # the runs with a cumsum, and its losses drawn in one more call.
+    def block(self, n=CHUNK):
+        index = []
+        lengths = []
+        need = n
+        while need > 0:
+            if self.run == len(self.runs): self.draw_runs(need)
+            runs = self.runs[self.run:]     # view: the current run is cut
+            ends = np.cumsum(runs)
+            k = int(np.searchsorted(ends, need))    # run that fills the block
+            if k == len(runs):
+                index.append(np.arange(self.run, len(self.runs)))
+                lengths.append(runs.copy())
+                need -= int(ends[-1])
+                self.run = len(self.runs)
+            else:
+                left = int(ends[k]) - need  # of run k, for the next block
+                take = runs[:k + 1].copy()
+                take[k] -= left
+                index.append(np.arange(self.run, self.run + k + 1))
+                lengths.append(take)
+                runs[k] = left
+                self.run += k + (left == 0)
+                need = 0
+        state = np.repeat(np.concatenate(index) & 1, np.concatenate(lengths))
+        return self.rng.random_sample(n) < self.loss[state]
+
+    # draw enough (good, bad) run pairs to likely cover need packets; a
+    # state that is never left has one endless run
+    def draw_runs(self, need):
+        mean = sum(1.0/p if p > 0 else need for p in self.leave)
+        pairs = int(need/mean) + 2
+        runs = np.empty(2*pairs, np.int64)
+        for state in (0, 1):
+            p = self.leave[state]
+            if p > 0: runs[state::2] = self.rng.geometric(p, pairs)
+            else: runs[state::2] = NEVER
+        self.runs = runs
+        self.run = 0
+
+
+# A packet is lost when its received signal strength, drawn from the
+# log-distance model of pass_loss_model (mean RSS at the link's length
+# plus log-normal shadowing), falls below threshold dBm.  scale converts
+# grid distance between the link's ends to metres.
+class DistanceLoss:
+    positional = True   # mobility.py gives moved links fresh samplers
+
+    def __init__(self, threshold, scale=1, n=PATH_LOSS_N, rss_ref=RSS_REF,
+                 sigma=SHADOWING_SIGMA):
+        self.threshold = threshold
+        self.scale = scale
+        self.n = n
+        self.rss_ref = rss_ref
+        self.sigma = sigma
+
+    def sampler(self, link, rng):
+        (loc1, loc2) = (link.end1.location, link.end2.location)
+        dist = max(math.hypot(loc1[0] - loc2[0], loc1[1] - loc2[1])*self.scale,
+                   1e-9)
+        mean = float(log_path_mean(dist, self.n, self.rss_ref))
+        lossprob = 1 - float(reception_probability(dist, self.threshold,
+                                                   self.n, self.rss_ref,
+                                                   self.sigma))
+        return DistanceSampler(mean, self.sigma, self.threshold, lossprob, rng)
+
+
+class DistanceSampler:
+    def __init__(self, mean, sigma, threshold, lossprob, rng):
+        self.mean = mean
+        self.sigma = sigma
+        self.threshold = threshold
+        self.lossprob = lossprob
+        self.rng = rng
+
+    def block(self, n=CHUNK):
+        rss = self.mean + self.sigma*self.rng.standard_normal(n)
+        return rss < self.threshold
@@ -0,0 +1,241 @@
+# Mobile nodes.
+#
+# Mobility(net,model,link_range) moves the nodes of net on every
+# simulation tick according to model, keeping net.nodes/find_node, the
+# links and (if attached) net.link_quality up to date:
+#
+#     net = TreeRouterNetwork(SIMTIME, NODES, LINKS, LOSSPROB)
+#     Mobility(net, RandomWaypoint(20, 20), link_range=3)
+#     net.reset(); net.step(1000)
+#
+# Two nodes are linked while they are at most link_range apart.  Nodes
+# sit in a uniform grid of link_range sized cells, so the nodes a moved
+# node may reach are all in its own and the 8 surrounding cells.  Only
+# moved nodes are looked at.  A link whose ends move out of range is
+# detached from both nodes (Node.remove_link), its queued packets are
+# dropped and its routers told through link_failed; it stays in
+# net.links, broken, as a free slot.  Links to newly reachable nodes
+# reuse a free slot before net.links grows, so link indices (ArrayCore,
+# HelloEngine, LinkQuality) stay stable and net.links stays as long as
+# the most links ever live at once.  Per-tick work is proportional to
+# the number of moved nodes and their neighbors.
+#
+# Models give a list of (node, (x, y)) for the nodes that moved by time:
+#
+# RandomWaypoint(width,height,speed=(0.5,1.5),pause=(0,10))
+# TraceMobility(trace)  -- trace is a list of (time, address, x, y)
+#
+# Mobility.step(time)   -- move nodes to where they are at time (called
+#                          by Network.step)
+#
+# Network.reset() leaves nodes where they are; the models start over.
+# With event_driven=True nodes only move on ticks where some node is
+# awake, so runs differ from lockstep ones.
+# DVRouterNetwork is built on the legacy net_sim classes, whose step()
+# knows nothing of mobility.
+
+import random, math, heapq
+
+
+# nodes bucketed by grid cell
+class GridIndex:
+    def __init__(self, cell):
+        self.cell = float(cell)
+        self.cells = {}     # (cx, cy) -> list of nodes, in arrival order
+        self.where = {}     # node -> its cell
+
+    def cell_of(self, loc):
+        return (int(math.floor(loc[0]/self.cell)),
+                int(math.floor(loc[1]/self.cell)))
+
+    # file node n under its current location; True if its cell changed
+    def update(self, n):
+        c = self.cell_of(n.location)
+        old = self.where.get(n)
+        if old == c: return False
+        if old is not None:
+            self.cells[old].remove(n)
+            if not self.cells[old]: del self.cells[old]
+        self.cells.setdefault(c, []).append(n)
+        self.where[n] = c
+        return True
+
+    # nodes in the cell of loc and the 8 cells around it
+    def near(self, loc):
+        (cx, cy) = self.cell_of(loc)
+        result = []
+        for x in (cx - 1, cx, cx + 1):
+            for y in (cy - 1, cy, cy + 1):
+                result.extend(self.cells.get((x, y), ()))
+        return result
+
+
+# Euclidean distance, computed as CostLink computes its cost
+def distance(n1, n2):
+    (loc1, loc2) = (n1.location, n2.location)
+    dx2 = (loc1[0] - loc2[0])*(loc1[0] - loc2[0])
+    dy2 = (loc1[1] - loc2[1])*(loc1[1] - loc2[1])
+    return math.sqrt(dx2 + dy2)
+
+
+class Mobility:
+    def __init__(self, network, model, link_range):
+        self.network = network
+        self.model = model
+        self.link_range = link_range
+        self.grid = GridIndex(link_range)
+        self.free = []      # detached links, ready for reuse
+        for n in network.nlist: self.grid.update(n)
+        network.mobility = self
+        # start from the links the initial positions give
+        self.moved(network.nlist)
+
+    def step(self, time):
+        moves = self.model.moves(self.network, time)
+        if not moves: return
+        net = self.network
+        for n, (x, y) in moves:
+            net.move_node(n, x, y)
+            self.grid.update(n)
+        self.moved([n for n, loc in moves])
+
+    # bring links of nodes up to date with their locations
+    def moved(self, nodes):
+        net = self.network
+        quality = getattr(net, 'link_quality', None)
+        for n in nodes:
+            peers = set()
+            for link in list(n.links):
+                other = link.end2 if link.end1 is n else link.end1
+                d = distance(n, other)
+                if d > self.link_range:
+                    self.detach(link)
+                    continue
+                peers.add(other)
+                if quality is None:
+                    link.cost = d
+                    self.resample(link)
+            for m in self.grid.near(n.location):
+                if m is n or m in peers: continue
+                if distance(n, m) <= self.link_range: self.connect(n, m)
+        # LinkQuality.apply gives new samplers to the links it updates
+        if quality is not None: quality.apply(quality.moved(nodes))
+
+    # link n1 and n2, in a free slot if there is one
+    def connect(self, n1, n2):
+        net = self.network
+        if self.free:
+            link = self.free.pop()
+            link.end1 = n1
+            link.end2 = n2
+            link.broken = False
+            link.cost = distance(n1, n2)
+            n1.add_link(link)
+            n2.add_link(link)
+            # a fresh link: no losses or tail drops yet
+            if hasattr(net, 'relink'): net.relink(link)   # array_core.ArrayCore
+            else:
+                link.linkloss = 0
+                link.taildrop = 0
+        else:
+            # as Network.add_link does
+            link = net.make_link(n1, n2)
+            link.network = net
+            net.links.append(link)
+        engine = getattr(net, 'hello_engine', None)
+        if engine is not None: engine.forget(link)
+        model = getattr(net, 'loss_model', None)
+        if model is not None and net.loss_rng is not None:
+            link.set_sampler(model.sampler(link, net.loss_rng))
+
+    # take link out of service and keep it as a free slot
+    def detach(self, link):
+        link.broken = True
+        for n in (link.end1, link.end2):
+            # packets still on their way are lost
+            while True:
+                got = link.receive(n)
+                if got is None: break
+                link.dropped(got[1])
+            n.remove_link(link)
+            neighbors = getattr(n, 'neighbors', None)
+            if neighbors is not None: neighbors.pop(link, None)
+            if hasattr(n, 'link_failed'): n.link_failed(link)
+        engine = getattr(self.network, 'hello_engine', None)
+        if engine is not None: engine.forget(link)
+        self.free.append(link)
+
+    # distance-based loss samplers follow the link's new length
+    def resample(self, link):
+        net = self.network
+        model = getattr(net, 'loss_model', None)
+        if getattr(model, 'positional', False) and net.loss_rng is not None:
+            link.set_sampler(model.sampler(link, net.loss_rng))
+
+
+# Random waypoint: each node picks a uniformly random point in the
+# width x height field and a speed (distance per tick) uniform in speed,
+# travels there in a straight line, pauses for a time uniform in pause,
+# and repeats.  Paused nodes cost nothing until they set off again.
+class RandomWaypoint:
+    def __init__(self, width, height, speed=(0.5, 1.5), pause=(0, 10)):
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.pause = pause
+        self.trips = None
+        self.time = None
+
+    # new trip for n from its location, leaving at time
+    def set_off(self, n, time):
+        (x0, y0) = n.location
+        x1 = random.uniform(0, self.width)
+        y1 = random.uniform(0, self.height)
+        speed = random.uniform(*self.speed)
+        duration = max(math.hypot(x1 - x0, y1 - y0)/speed, 1)
+        self.trips[n] = (x0, y0, x1, y1, time, time + duration)
+
+    def moves(self, net, time):
+        if self.trips is None or time < self.time:
+            # first call, or the network was reset: everybody sets off
+            self.trips = {}     # moving node -> (x0, y0, x1, y1, t0, t1)
+            self.paused = []    # heap of (resume time, rank, node)
+            self.rank = {}
+            for i, n in enumerate(net.nlist):
+                self.rank[n] = i
+                heapq.heappush(self.paused, (time, i, n))
+        self.time = time
+        while self.paused and self.paused[0][0] <= time:
+            (resume, i, n) = heapq.heappop(self.paused)
+            self.set_off(n, resume)
+        result = []
+        # nlist order, so random draws don't depend on dict order
+        for n in sorted(self.trips, key=self.rank.get):
+            (x0, y0, x1, y1, t0, t1) = self.trips[n]
+            if time >= t1:
+                result.append((n, (x1, y1)))
+                del self.trips[n]
+                heapq.heappush(self.paused, (t1 + random.uniform(*self.pause),
+                                             self.rank[n], n))
+            elif time > t0:
+                f = (time - t0)/(t1 - t0)
+                result.append((n, (x0 + f*(x1 - x0), y0 + f*(y1 - y0))))
+        return result
+
+
+# Replays recorded positions: trace holds (time, address, x, y) records,
+# and a node jumps to (x, y) once the simulation reaches time.
+class TraceMobility:
+    def __init__(self, trace):
+        self.trace = sorted(trace)
+        self.next = 0
+
+    def moves(self, net, time):
+        if self.next > 0 and self.trace[self.next - 1][0] > time:
+            self.next = 0   # network was reset, replay from the start
+        result = []
+        while self.next < len(self.trace) and self.trace[self.next][0] <= time:
+            (t, address, x, y) = self.trace[self.next]
+            result.append((net.addresses[address], (x, y)))
+            self.next += 1
+        return result
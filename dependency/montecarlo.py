@@ -0,0 +1,106 @@
+# Monte Carlo runner: simulate many independent replicas of one network
+# configuration on a process pool and gather per-run metrics.
+#
+# run_replicas(factory,nreplicas,steps,...) -- run replicas, return columns
+# run_replica(spec)                         -- run one replica (in a worker)
+# replica_seed(seed,i)                      -- seed used for replica i
+# routing_state(net)                        -- snapshot of routing tables
+#
+# factory(**params) must build a fresh network (e.g. a TreeRouterNetwork
+# or DVRouterNetwork) and be picklable, i.e. a module-level function.
+# Each replica seeds both `random' and `np.random' with replica_seed()
+# before calling it, so a run only depends on (seed, replica index).
+
+import random, multiprocessing
+import numpy as np
+
+METRICS = ('seed', 'replica', 'time', 'convergence_time', 'npackets',
+           'delivered', 'dropped', 'linkloss', 'taildrop',
+           'queue_mean', 'queue_max')
+
+
+# deterministic, well spread 32-bit seed for replica i of a batch
+def replica_seed(seed, i):
+    return (seed * 1000003 + i * 7919 + 12345) % 2**32
+
+
+# everything that routing protocols converge on, node by node
+def routing_state(net):
+    state = []
+    for n in net.nlist:
+        state.append((getattr(n, 'parent', None),
+                      getattr(n, 'hopCount', None),
+                      tuple(sorted(getattr(n, 'spcost', {}).items()))))
+    return tuple(state)
+
+
+# spec = (factory, params, steps, seed, replica, interval).  Steps the
+# network interval ticks at a time; convergence_time is the end of the
+# last chunk in which routing_state changed.
+def run_replica(spec):
+    (factory, params, steps, seed, replica, interval) = spec
+    random.seed(seed)
+    np.random.seed(seed)
+    net = factory(**params)
+    # delivered counts DATA packets only; HELLO and ADVERT packets are
+    # 'received' too, by the routers that consume them
+    counts = {'received': 0, 'dropped': 0}
+    def count(event, p, time):
+        if event == 'received':
+            if p.type == 'DATA': counts['received'] += 1
+        elif event in counts: counts[event] += 1
+    traced = hasattr(net, 'subscribe')
+    if traced: net.subscribe(count)
+    net.reset()
+
+    state = routing_state(net)
+    converged = net.time
+    while net.time < steps:
+        net.step(min(interval, steps - net.time))
+        now = routing_state(net)
+        if now != state:
+            state = now
+            converged = net.time
+        if net.pending == 0: break
+
+    queue_sum = sum(getattr(n, 'queue_length_sum', 0) for n in net.nlist)
+    return {'seed': seed,
+            'replica': replica,
+            'time': net.time,
+            'convergence_time': converged,
+            'npackets': net.npackets,
+            'delivered': counts['received'] if traced else -1,
+            'dropped': counts['dropped'] if traced else -1,
+            'linkloss': sum(getattr(l, 'linkloss', 0) for l in net.links),
+            'taildrop': sum(getattr(l, 'taildrop', 0) for l in net.links),
+            'queue_mean': queue_sum/float(max(net.time, 1)*len(net.nlist)),
+            'queue_max': max([getattr(n, 'queue_length_max', 0)
+                              for n in net.nlist] or [0])}
+
+
+# turn a list of per-run metric dicts into a dict of NumPy columns
+def columns(rows, names=METRICS):
+    return dict((name, np.array([row[name] for row in rows]))
+                for name in names)
+
+
+# Run nreplicas independent replicas of factory(**params) for steps ticks
+# each, on `processes' worker processes (default: one per core; 1 runs
+# them in this process).  Returns a dict of NumPy arrays, one entry per
+# replica in replica order (see METRICS).  delivered is the number of
+# DATA packets received, dropped the number of packets of any type
+# dropped by links; both are -1 for networks without packet tracing.
+def run_replicas(factory, nreplicas, steps, params=None, seed=0,
+                 processes=None, interval=20):
+    specs = [(factory, params or {}, steps, replica_seed(seed, i), i, interval)
+             for i in range(nreplicas)]
+    if processes == 1:
+        rows = map(run_replica, specs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            rows = pool.map(run_replica, specs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return columns(rows)
@@ -1,10 +1,90 @@
 import math
 import numpy as np
+from scipy.special import ndtr
+
+# log-distance path-loss parameters, calibrated on 1m
+PATH_LOSS_N = 1.276     # path-loss exponent
+RSS_REF = -32           # RSS at the 1m reference distance (dBm)
+SHADOWING_SIGMA = 1     # std dev of log-normal shadowing (dB)
 
 
 def log_path_model(dist):
     # calibrate on 1m
-    n = 1.276
-    rss_ref = -32
-    rss = rss_ref - 10*n*math.log10(dist) + np.random.normal(0, 1, 1)
-    return rss
\ No newline at end of file
+    n = PATH_LOSS_N
+    rss_ref = RSS_REF
+    rss = rss_ref - 10*n*math.log10(dist) + np.random.normal(0, SHADOWING_SIGMA, 1)
+    return rss
+
+
+# Batched log_path_model: RSS for every entry of an array (or distance
+# matrix) of distances, with one shadowing draw per entry taken in a
+# single NumPy call.  Draws come out of np.random in the same order as
+# calling log_path_model on the flattened distances one by one.
+def log_path_model_batch(dist, n=PATH_LOSS_N, rss_ref=RSS_REF,
+                         sigma=SHADOWING_SIGMA):
+    dist = np.asarray(dist, dtype=float)
+    return rss_ref - 10*n*np.log10(dist) + np.random.normal(0, sigma, dist.shape)
+
+
+# Mean RSS of the log-distance model (no shadowing) for scalar or array
+# distances.
+def log_path_mean(dist, n=PATH_LOSS_N, rss_ref=RSS_REF):
+    return rss_ref - 10*n*np.log10(np.asarray(dist, dtype=float))
+
+
+# Probability that a packet's RSS, log_path_model at distance dist, is
+# at least threshold dBm: the packet reception rate of a receiver with
+# that sensitivity.  Works on scalars and on arrays of any shape.
+def reception_probability(dist, threshold, n=PATH_LOSS_N, rss_ref=RSS_REF,
+                          sigma=SHADOWING_SIGMA):
+    margin = log_path_mean(dist, n, rss_ref) - threshold
+    if sigma > 0: return ndtr(margin/float(sigma))
+    return (margin >= 0).astype(float)
+
+
+# Distance beyond which a node's RSS-estimated distance falls under
+# `threshold' with probability below that of a k-sigma shadowing draw
+# (about 1e-9 for k=6).  Neighbour searches can ignore anything further.
+def max_plausible_distance(threshold, k=6, n=PATH_LOSS_N,
+                           sigma=SHADOWING_SIGMA):
+    return threshold * 10**(k*sigma/(10.0*n))
+
+
+# Closed-form inverse of the log-distance model (shadowing ignored):
+# the distance at which the model's mean RSS equals rss.  Works on
+# scalars and on arrays of any shape.
+def log_path_inverse(rss, n=PATH_LOSS_N, rss_ref=RSS_REF):
+    return 10**((rss_ref - np.asarray(rss, dtype=float))/(10.0*n))
+
+
+# Least-squares fit of the log-distance model to (distance, RSS) samples.
+# rss = rss_ref - 10*n*log10(dist) is linear in x = -10*log10(dist), so
+# the fit only needs the sums of x, y, x*x, x*y and y*y, gathered in one
+# pass over the samples.  Returns (n, rss_ref, sigma), sigma being the
+# residual standard deviation (the shadowing estimate).  Raises
+# ValueError unless dist and rss pair up, every distance is positive and
+# the samples cover at least two distances.
+def fit_log_path_model(dist, rss):
+    dist = np.asarray(dist, dtype=float).ravel()
+    y = np.asarray(rss, dtype=float).ravel()
+    if len(dist) != len(y):
+        raise ValueError, 'got %d distances but %d RSS samples' % \
+              (len(dist), len(y))
+    if (dist <= 0).any():
+        raise ValueError, 'path-loss distances must be positive'
+    x = -10*np.log10(dist)
+    count = float(len(x))
+    if count < 2:
+        raise ValueError, 'need at least 2 samples to fit the path-loss model'
+    if np.ptp(x) == 0:
+        raise ValueError, 'path-loss samples are all at one distance'
+    sx = x.sum()
+    sy = y.sum()
+    # centred second moments
+    sxx = np.dot(x, x) - sx*sx/count
+    sxy = np.dot(x, y) - sx*sy/count
+    syy = np.dot(y, y) - sy*sy/count
+    n = sxy/sxx
+    rss_ref = (sy - n*sx)/count
+    sigma = math.sqrt(max(syy - n*sxy, 0)/max(count - 2, 1))
+    return n, rss_ref, sigma
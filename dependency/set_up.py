@@ -2,10 +2,15 @@
 # This file defines top-layer objects, network, router, randomGraph
 
 from bottomLayer import *
+import heapq
+import numpy as np
+from collections import deque
 import scipy.spatial.distance as sci_dist
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from matplotlib import collections as mc
 from pass_loss_model import *
+from hello import HelloEngine
 
 ################################################################################
 #
@@ -14,31 +19,74 @@ from pass_loss_model import *
 # Network.make_node(loc,address=None)  -- make a new network node
 # Network.add_node(x,y,address=None)   -- add a new node at specified location
 # Network.find_node(x,y)               -- return node at given location
+# Network.move_node(n,x,y)             -- move node n to a new location
 # Network.map_node(f,default=0)        -- see below
 # Network.make_link(n1,n2)             -- make a new link between n1 and n2
 # Network.add_link(x1,y2,x2,y2)        -- add link between specified nodes
 #
 # Network.make_packet(src,dst,type,start,**props)  -- make a new packet
 # Network.duplicate_packet(p)          -- duplicate a packet
+# Network.subscribe(f)                 -- call f(event,p,time) on packet events
+# Network.unsubscribe(f)               -- stop calling f
+# Network.packet_event(event,p)        -- report 'created', 'received' or
+#                                         'dropped' to subscribers
+# Network.release_packet(p)            -- p is dead, recycle it if pooling
 #
 # Network.reset()                      -- initialize network state
 # Network.step(count=1)                -- simulate count timesteps
+# Network.packet_queued(n,p)           -- note packet start for scheduler
+#
+# With event_driven=True, step() only wakes the nodes that have work due
+# at a given tick (link deliveries, transmit timers, packet starts) and
+# skips idle ticks entirely.  Packet traces match the lockstep mode.
+# The event heap costs more than it saves unless the network is large:
+# TreeRouterNetwork on the 22-node RandomGraph runs about 30% slower
+# event-driven (5.5s against 4.3s), the two are about even from 100 to
+# 800 nodes, and at 1600 nodes event-driven is about 10% faster (32.6s
+# against 36.6s).  Routers wake every node on each HELLO/ADVERT tick,
+# which limits what can be skipped.  Lockstep stays the default.
+#
+# retention controls what Network.packets keeps: 0 (default) keeps
+# nothing, N > 0 keeps a ring of the last N packets and None keeps every
+# packet ever made.  npackets always counts every packet.
+#
+# With pool=True, packets consumed by a router or dropped by a link are
+# recycled by make_packet instead of being garbage collected.  Nothing may
+# hold on to a packet after it has been released; pool_debug=True poisons
+# released packets instead of reusing them, so any later use raises.
+# Packets are only recycled when retention is 0, since traced packets
+# must stay intact.
 #
 ################################################################################
 class Network:
-    def __init__(self,simtime):
+    def __init__(self,simtime,event_driven=False,retention=0,pool=False,
+                 pool_debug=False):
         self.nodes = {}
         self.addresses = {}
         self.nlist = []
         self.links = []
         self.time = 0
         self.pending = 0
-        self.packets = []
+        self.retention = retention
+        self.packets = deque(maxlen=retention)
         self.npackets = 0
+        self.listeners = []     # packet lifecycle subscribers
+        self.pool = pool or pool_debug
+        self.pool_debug = pool_debug
+        self.free_packets = []  # released packets ready for reuse
+        self.property_templates = {}    # packet type -> shared properties
+        self.nrecycled = 0      # packets made from the pool
         self.max_x = 0
         self.max_y = 0
         self.simtime = simtime
         self.playstep = 1.0     # 1 second play step by default
+        self.event_driven = event_driven
+        self.events = None      # heap of (time, node rank), built lazily
+        self.scheduled = set()  # (time, node rank) pairs already on heap
+        self.queued = {}        # node rank -> transmit queue length
+        self.rank = {}          # node -> index in nlist
+        self.horizon = 0        # earliest tick a new event may use
+        self.mobility = None    # mobility.Mobility moving nodes each tick
 
         self.numnodes = 0       # TBD
 
@@ -62,6 +110,20 @@ class Network:
             self.max_y = max(self.max_y,y)
         return n
 
+    # move node n to (x,y), keeping find_node up to date
+    def move_node(self,n,x,y):
+        (ox,oy) = n.location
+        ynodes = self.nodes.get(ox)
+        if ynodes is not None and ynodes.get(oy) is n:
+            del ynodes[oy]
+            if not ynodes: del self.nodes[ox]
+        n.location = (x,y)
+        ynodes = self.nodes.get(x,{})
+        ynodes[y] = n
+        self.nodes[x] = ynodes
+        self.max_x = max(self.max_x,x)
+        self.max_y = max(self.max_y,y)
+
     def set_nodes(self,n):
         self.numnodes = n
 
@@ -100,12 +162,44 @@ class Network:
 
     # override to make your own type of packet
     def make_packet(self,src,dest,type,start,**props):
-        p = Packet(src,dest,type,start,**props)
+        if self.free_packets:
+            p = self.free_packets.pop()
+            p.__init__(src,dest,type,start,**props)
+            self.nrecycled += 1
+        else: p = Packet(src,dest,type,start,**props)
+        share_properties(p,self.property_templates)
         p.network = self
         self.packets.append(p)
         self.npackets += 1
+        if self.listeners: self.packet_event('created',p)
         return p
 
+    # packet lifecycle tracing: f(event,p,time) is called for every
+    # packet created, received (consumed by its destination or by a
+    # router's protocol handler) or dropped by a link
+    def subscribe(self,f):
+        self.listeners.append(f)
+
+    def unsubscribe(self,f):
+        self.listeners.remove(f)
+
+    def packet_event(self,event,p):
+        for f in self.listeners: f(event,p,self.time)
+
+    # called once a packet has been consumed or dropped
+    def release_packet(self,p):
+        if not self.pool or self.retention != 0: return
+        if self.pool_debug:
+            if type(p) is ReleasedPacket:
+                raise Exception,'packet released twice'
+            p.__class__ = ReleasedPacket
+            return
+        # drop references so payloads can be collected
+        p.network = None
+        p.hops = None
+        p.properties = None
+        self.free_packets.append(p)
+
     # duplicate existing packet
     def duplicate_packet(self,old):
         return self.make_packet(old.source,old.destination,old.type,self.time,
@@ -122,15 +216,20 @@ class Network:
         for n in self.nlist: n.reset()
         self.time = 0
         self.pending = 0
-        self.packets = []
+        self.packets = deque(maxlen=self.retention)
         self.npackets = 0
+        self.property_templates = {}
         self.pending = 1    # ensure at least simulation step
+        self.events = None  # scheduler is re-seeded on the next step
 
     # simulate network one timestep at a time.  At each timestep
     # each node processes one packet from each of its incoming links
     def step(self,count=1):
+        if self.event_driven: return self.step_events(count)
         stop_time = self.time + count
         while self.time < stop_time and self.pending > 0:
+            if self.mobility is not None: self.mobility.step(self.time)
+
             # phase 1: nodes collect one packet from each link
             for n in self.nlist: n.phase1()
 
@@ -144,6 +243,95 @@ class Network:
             self.time += 1
         return self.pending
 
+    #########################################################
+    # event-driven scheduler
+    #########################################################
+
+    # ask for node n to be woken at simulation time `when'
+    def wake(self,n,when):
+        if self.events is None or when is None: return
+        # work can't be done in a tick that has already been collected
+        when = max(when,self.horizon)
+        key = (when,self.rank[n])
+        if key not in self.scheduled:
+            self.scheduled.add(key)
+            heapq.heappush(self.events,key)
+
+    # called by Node.add_packet whenever a packet joins a transmit queue
+    def packet_queued(self,n,p):
+        if self.events is None: return
+        self.queued[self.rank[n]] = len(n.transmit_queue)
+        self.wake(n,n.next_wakeup(self.horizon))
+
+    # (re)build the event heap from scratch: every node gets a look at
+    # the current time, which picks up anything queued before stepping
+    def seed_events(self):
+        self.rank = dict((n,i) for i,n in enumerate(self.nlist))
+        self.events = []
+        self.scheduled = set()
+        self.queued = {}
+        self.horizon = self.time
+        for n in self.nlist:
+            if len(n.transmit_queue) > 0:
+                self.queued[self.rank[n]] = len(n.transmit_queue)
+            self.wake(n,self.time)
+
+    # same semantics as step(), but only nodes with something to do at a
+    # tick run phase1/phase2 there, and ticks where nobody does are
+    # skipped.  Nodes are still visited in nlist order within a tick so
+    # random draws happen in the same sequence as in lockstep mode.
+    def step_events(self,count=1):
+        if self.events is None: self.seed_events()
+        stop_time = self.time + count
+        events = self.events
+        while self.time < stop_time and self.pending > 0:
+            if len(events) == 0 or events[0][0] >= stop_time:
+                # nothing happens before stop_time; idle ticks leave
+                # pending unchanged
+                self.time = stop_time
+                break
+            now = max(events[0][0],self.time)
+            self.time = now
+            self.horizon = now + 1
+            # nodes move to where they are at `now', skipped ticks and all
+            if self.mobility is not None: self.mobility.step(now)
+
+            # collect every node due at this tick, in nlist order
+            ranks = set()
+            while len(events) > 0 and events[0][0] <= now:
+                key = heapq.heappop(events)
+                self.scheduled.discard(key)
+                ranks.add(key[1])
+            ranks = sorted(ranks)
+            active = [self.nlist[i] for i in ranks]
+
+            # phase 1 and phase 2 exactly as in step()
+            for n in active: n.phase1()
+            self.pending = 0
+            for i,n in zip(ranks,active):
+                self.pending += n.phase2(now)
+                if len(n.transmit_queue) > 0:
+                    self.queued[i] = len(n.transmit_queue)
+                else: self.queued.pop(i,None)
+                # transmit timer
+                self.wake(n,n.next_wakeup(now + 1))
+                # link deliveries: both ends of a busy link stay awake,
+                # the receiver to collect and the sender for queue stats
+                for link in n.links:
+                    if link.queue_length(link.end1) > 0 or \
+                       link.queue_length(link.end2) > 0:
+                        self.wake(link.end1,now + 1)
+                        self.wake(link.end2,now + 1)
+
+            # idle nodes only contribute their unsent packets
+            awake = set(ranks)
+            for i,qlen in self.queued.items():
+                if i not in awake: self.pending += qlen
+
+            self.time = now + 1
+        self.horizon = self.time
+        return self.pending
+
 ################################################################################
 #
 # Router base class
@@ -164,6 +352,8 @@ class Router(Node):
         self.routes[self.address] = 'Self'
         self.spcost = {}        # address -> shortest path cost to node
         self.spcost[self.address] = 0
+        self.link_to = {}       # neighbor address -> Link
+        self.peer_of = {}       # Link -> neighbor address
         self.hello_offset = random.randint(0, self.HELLO_INTERVAL-1)
         self.ad_offset = random.randint(0, self.ADVERT_INTERVAL-1)
         self.hello_offset = 0
@@ -173,15 +363,33 @@ class Router(Node):
         Node.reset(self)
         self.spcost[self.address] = 0
 
+    # keep the neighbor address <-> link maps up to date
+    def add_link(self, l):
+        Node.add_link(self, l)
+        if l.end1 is self: nbhr = l.end2.address
+        else: nbhr = l.end1.address
+        self.peer_of[l] = nbhr
+        self.link_to.setdefault(nbhr, l)
+
+    def remove_link(self, l):
+        Node.remove_link(self, l)
+        nbhr = self.peer_of.pop(l, None)
+        if self.link_to.get(nbhr) is l:
+            del self.link_to[nbhr]
+            # fall back to another link to the same neighbor, if any
+            for other in self.links:
+                if self.peer_of[other] == nbhr:
+                    self.link_to[nbhr] = other
+                    break
+
     # return the link corresponding to a given neighbor, nbhr
     def getlink(self, nbhr):
         if self.address == nbhr: return None
-        for l in self.links:
-            if l.end2.address == nbhr or l.end1.address == nbhr:
-                return l
-	return None
+        return self.link_to.get(nbhr)
 
     def peer(self, link):
+        nbhr = self.peer_of.get(link)
+        if nbhr is not None: return nbhr
         if link.end1.address == self.address: return link.end2.address
         if link.end2.address == self.address: return link.end1.address
 
@@ -195,6 +403,8 @@ class Router(Node):
             link.send(self, p)
 
     def process(self,p,link,time):
+        if self.network.listeners and p.type in ('HELLO','ADVERT','DATA'):
+            self.network.packet_event('received',p)
         if p.type == 'HELLO':
             # remember addresses of our neighbors and time of latest update
             self.neighbors[link] = (time, p.source, link.cost)
@@ -204,6 +414,9 @@ class Router(Node):
             self.process_data(p, time)
         else:
             Node.process(self, p, link, time)
+            return
+        # HELLO, ADVERT and DATA packets are consumed here
+        self.network.release_packet(p)
 
     def process_advertisement(self,p,link,time):
         # will be filled in by the specific routing protocol
@@ -216,6 +429,10 @@ class Router(Node):
         # STEP 1(a): send HELLO packets along all my links to neighbors
         # These periodic HELLOs tell our neighbors I'm still alive
         # The neighbors will get my address from the source address field
+        engine = getattr(self.network,'hello_engine',None)
+        if engine is not None:
+            engine.tick(time)   # everybody's HELLOs for this tick at once
+            return
         for link in self.links:
             p = self.network.make_packet(self.address, self.peer(link),
                                          'HELLO', time,color='green')
@@ -225,6 +442,11 @@ class Router(Node):
     def clearStaleHello(self, time):
         # STEP 1(b) : Look through neighbors table and eliminate
         # out-of-date entries.
+        engine = getattr(self.network,'hello_engine',None)
+        if engine is not None:
+            for link in engine.stale(self,time):
+                self.link_failed(link)
+            return
         old = time - 2*self.HELLO_INTERVAL
         for link in self.neighbors.keys():
             if self.neighbors[link][0] <= old:
@@ -235,6 +457,12 @@ class Router(Node):
     def link_failed(self,link):
         pass
 
+    # transmit() below only does work on HELLO/ADVERT ticks
+    def next_wakeup(self,time):
+        hello = time + (self.hello_offset - time) % self.HELLO_INTERVAL
+        advert = time + (self.ad_offset - time) % self.ADVERT_INTERVAL
+        return min(hello,advert)
+
     def clear_routes(self,link):
         clear_list = []
         for dest in self.routes:
@@ -258,19 +486,35 @@ class Router(Node):
         if which == 'left':
             #print whatever debugging information you want to print
             print self
-            print '  neighbors:',self.neighbors.values()
+            engine = getattr(self.network,'hello_engine',None)
+            if engine is not None: neighbors = engine.neighbors(self)
+            else: neighbors = self.neighbors
+            print '  neighbors:',neighbors.values()
             print '  routes:'
             for (key,value) in self.routes.items():
                 print '    ',key,': ',value, 'pathcost %.2f' % self.spcost[key]
 
 
 # Network with link costs.  By default, the cost of a link is the
-# Euclidean distance between the nodes at the ends of the link
+# Euclidean distance between the nodes at the ends of the link.
+# With vector_hello=True, neighbor liveness is simulated by a
+# hello.HelloEngine instead of HELLO packets.  loss_model (see
+# loss_model.py) replaces each link's per-packet random.random() loss
+# draw with decisions sampled in bulk.
 class RouterNetwork(Network):
-    def __init__(self,SIMTIME,NODES,LINKS,LOSSPROB):
-        Network.__init__(self,SIMTIME)
+    def __init__(self,SIMTIME,NODES,LINKS,LOSSPROB,link_capacity=None,
+                 vector_hello=False,loss_model=None,**options):
+        # options (event_driven, retention, ...) go to Network
+        Network.__init__(self,SIMTIME,**options)
+
+        self.loss_model = loss_model
+        self.loss_rng = None
+
+        self.hello_engine = None
+        if vector_hello: self.hello_engine = HelloEngine(self)
 
         self.lossprob = LOSSPROB
+        self.link_capacity = link_capacity  # per-direction queue bound
         for n,r,c in NODES:
             self.add_node(r,c,address=n)
         for a1,a2 in LINKS:
@@ -284,7 +528,8 @@ class RouterNetwork(Network):
         return Router(loc,address=address)
 
     def make_link(self,n1,n2):
-        return LossyCostLink(n1,n2,self.lossprob)
+        return LossyCostLink(n1,n2,self.lossprob,
+                             capacity=self.link_capacity)
 
 #    def add_cost_link(self,x1,y1,x2,y2):
 #        n1 = self.find_node(x1,y1)
@@ -298,6 +543,12 @@ class RouterNetwork(Network):
     def reset(self):
         # parent class handles the details
         Network.reset(self)
+        if self.loss_model is not None:
+            # fresh samplers on every reset, seeded from `random'
+            self.loss_rng = np.random.RandomState(random.getrandbits(32))
+            for link in self.links:
+                link.set_sampler(self.loss_model.sampler(link,self.loss_rng))
+        if self.hello_engine is not None: self.hello_engine.reset()
         # insert a single packet into the network with randomly
         # chosen source and destination.  Since we don't have code
         # to deliver the packet this just keeps the simulation alive...
@@ -351,11 +602,38 @@ class RandomGraph:
                          [7.5, -2.5]]
         self.dist_matr = []
 
+        # TODO: vary distance threshold to see its impacts on tree structure (miniumum is 6)
+        self.dist_threshold = 6
+        # neighbour search radius; None derives it from the path-loss
+        # model so pruned candidates could essentially never qualify
+        self.max_radius = None
+        self.coords = None      # position array, built lazily
+        self.kdtree = None      # spatial index over positions, built lazily
+        # path-loss model used for RSS reports
+        self.path_loss_n = PATH_LOSS_N
+        self.rss_ref = RSS_REF
+        self.sigma = SHADOWING_SIGMA
+        self.ngbrs = None       # neighbour lists from the last genGraph
+        self.edges = None       # (L, 2) index pairs from the last genGraph
+
     def rss_report(self, ind, x, y):
         (nx, ny) = self.getCoord(ind)
         rss = log_path_model(sci_dist.euclidean([nx, ny], [x, y]))
         return rss
 
+    # RSS array as heard at (x, y) from each node index in inds
+    def rss_reports(self, inds, x, y):
+        pos = self.getPositions()[inds]
+        dist = np.hypot(pos[:, 0] - x, pos[:, 1] - y)
+        return log_path_model_batch(dist, n=self.path_loss_n,
+                                    rss_ref=self.rss_ref, sigma=self.sigma)
+
+    # node positions as an (numnodes, 2) array
+    def getPositions(self):
+        if self.coords is None:
+            self.coords = np.asarray(self.position[:self.numnodes], dtype=float)
+        return self.coords
+
     def getCoord(self, i):
         x = self.position[i][0]
         y = self.position[i][1]
@@ -379,24 +657,44 @@ class RandomGraph:
         eff_range = max(min_ranges) + 0.3
         return eff_range
 
+    # translate rssi (a scalar or an array) into physical distance by
+    # inverting the log-distance model
     def rss2dist(self, rssi):
-        # TODO: translate rssi into physical distance
-        pass
+        dist = log_path_inverse(rssi, n=self.path_loss_n, rss_ref=self.rss_ref)
         return dist
 
+    # fit the path-loss model to measured (distance, RSS) samples
+    def calibrate(self, dist, rss):
+        (self.path_loss_n, self.rss_ref, self.sigma) = \
+            fit_log_path_model(dist, rss)
+        return (self.path_loss_n, self.rss_ref, self.sigma)
+
+    def getRadius(self):
+        if self.max_radius is not None:
+            return self.max_radius
+        return max_plausible_distance(self.dist_threshold,
+                                      n=self.path_loss_n, sigma=self.sigma)
+
+    # indices of the nodes within search radius of node i, in index order
+    def getCandidates(self, i):
+        if self.kdtree is None:
+            self.kdtree = cKDTree(self.getPositions())
+        candiNgbrs = self.kdtree.query_ball_point(self.position[i],
+                                                  self.getRadius())
+        candiNgbrs.sort()
+        candiNgbrs.remove(i)
+        return candiNgbrs
+
     def getAllNgbrs_distance(self, i):
         (x, y) = self.getCoord(i)
         ngbrs = []
-        candiNgbrs = range(self.numnodes)
-        candiNgbrs.pop(i)
-        for nodeInd in candiNgbrs:
-            rssi = self.rss_report(nodeInd, x, y)
-            trans_dist = self.rss2dist(rssi) # rss2dist(rssi) to complete
-
-            # TODO: vary distance threshold to see its impacts on tree structure (miniumum is 6)
-            dist_threshold = 6
-
-            if trans_dist <= dist_threshold:
+        # only nodes close enough to plausibly be heard are measured,
+        # all in one batch
+        candiNgbrs = self.getCandidates(i)
+        rss = self.rss_reports(candiNgbrs, x, y)
+        trans_dist = self.rss2dist(rss)
+        for nodeInd, heard in zip(candiNgbrs, trans_dist <= self.dist_threshold):
+            if heard:
                 ngbrs.append(nodeInd)
 
         return ngbrs
@@ -409,28 +707,41 @@ class RandomGraph:
                 return True
         return False
 
-    def genGraph(self):
+    # Returns (NODES, LINKS) as name tuples.  With edges=True, also
+    # returns an (L, 2) int array of node index pairs in LINKS order.
+    def genGraph(self, edges=False):
         NODES = []
         LINKS = []
+        linked = set()          # (low index, high index) of each link
+        pairs = []
 
         for i in range(self.numnodes):
             (x,y) = self.getCoord(i)
             name = self.names[i]
             NODES.append((name,x,y))
 
+        self.ngbrs = []
         for i in range(self.numnodes):
             ngbrs = self.getAllNgbrs_distance(i)
+            self.ngbrs.append(ngbrs)
 
             for n in ngbrs:
-                if not self.checkLinkExists(LINKS, self.names[i], self.names[n]):
+                key = (min(i, n), max(i, n))
+                if key not in linked:
+                    linked.add(key)
+                    pairs.append((i, n))
                     LINKS.append((self.names[i], self.names[n]))
 
+        self.edges = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+        if edges:
+            return (NODES, LINKS, self.edges)
         return (NODES, LINKS)
 
     def drawGraph(self):
         plt.close()
         fig, ax = plt.subplots()
         lines = []
+        drawn = set()
         for i in range(self.numnodes):
             (x, y) = self.getCoord(i)
             if i == 0:
@@ -439,13 +750,15 @@ class RandomGraph:
             else:
                 plt.scatter(x, y, s=280, facecolors='none', edgecolors='#551A8B',linewidths =1.5)
                 plt.text(x - 0.27, y - 0.3, self.names[i], fontsize=12)
-            ngbrs = self.getAllNgbrs_distance(i)
+            # draw the graph genGraph built rather than measuring again
+            if self.ngbrs is not None: ngbrs = self.ngbrs[i]
+            else: ngbrs = self.getAllNgbrs_distance(i)
             # Creating line obj
             for ng in ngbrs:
                 (nx, ny) = self.getCoord(ng)
                 line = [(x, y), (nx, ny)]
-                line_1 = [(nx, ny), (x, y)]
-                if line_1 not in lines:
+                if (ng, i) not in drawn:
+                    drawn.add((i, ng))
                     lines.append(line)
         lc = mc.LineCollection(lines, colors='#FF69B4', linewidths=2)
         ax.add_collection(lc)
@@ -0,0 +1,151 @@
+# Parameter sweeps: run replicas of a RouterNetwork subclass over a grid
+# of loss probability, node count, range threshold and HELLO/ADVERT
+# intervals, on a process pool, appending results to a CSV file.
+#
+# sweep(network_class,grid,steps,path,...) -- run the grid, return columns
+# grid_points(grid)                        -- expand grid into point dicts
+# make_topology(numnodes,threshold,seed)   -- default topology generator
+#
+# Topologies only depend on (numnodes, threshold), so each is generated
+# once and shared by every point that differs only in protocol
+# parameters (lossprob and the intervals).  Each finished replica is
+# written to `path' straight away; running the same sweep again skips
+# the (point, replica) pairs already in the file, so an interrupted
+# sweep resumes where it stopped.
+
+import csv, os, itertools, multiprocessing
+import numpy as np
+from set_up import RandomGraph, Router
+from montecarlo import METRICS, replica_seed, run_replica
+
+# grid parameters and their defaults; numnodes/threshold shape the
+# topology, the rest are protocol parameters
+PARAMETERS = (('numnodes', 22),
+              ('threshold', 6),
+              ('lossprob', 0),
+              ('hello_interval', Router.HELLO_INTERVAL),
+              ('advert_interval', Router.ADVERT_INTERVAL))
+TOPOLOGY = ('numnodes', 'threshold')
+
+
+# (NODES, LINKS) from RandomGraph with the given range threshold
+def make_topology(numnodes, threshold, seed):
+    np.random.seed(seed)
+    graph = RandomGraph(numnodes)
+    graph.dist_threshold = threshold
+    return graph.genGraph()
+
+
+# builds one sweep point's network; a class so it pickles to workers
+class SweepFactory:
+    def __init__(self, network_class, topology, hello_interval,
+                 advert_interval, simtime):
+        self.network_class = network_class
+        self.topology = topology
+        self.hello_interval = hello_interval
+        self.advert_interval = advert_interval
+        self.simtime = simtime
+
+    def __call__(self, lossprob=0):
+        (NODES, LINKS) = self.topology
+        net = self.network_class(self.simtime, NODES, LINKS, lossprob)
+        for n in net.nlist:
+            n.HELLO_INTERVAL = self.hello_interval
+            n.ADVERT_INTERVAL = self.advert_interval
+        return net
+
+
+# every combination of the grid's values, missing parameters defaulted
+def grid_points(grid):
+    names = [name for name, default in PARAMETERS]
+    values = [list(grid.get(name, [default])) for name, default in PARAMETERS]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+# Parameters are compared as floats: the csv module writes floats with
+# repr(), so their text need not match str() of the grid value.
+def point_key(point, replica):
+    return tuple(float(point[name]) for name, default in PARAMETERS) + \
+           (int(replica),)
+
+
+# (point, replica) keys already recorded in a results file
+def finished(path):
+    done = set()
+    if not os.path.exists(path): return done
+    with open(path, 'rb') as f:
+        for row in csv.DictReader(f):
+            done.add(tuple(float(row[name]) for name, default in PARAMETERS)
+                     + (int(row['replica']),))
+    return done
+
+
+def run_point(job):
+    (point, spec) = job
+    return point, run_replica(spec)
+
+
+# Run `replicas' replicas of every grid point for `steps' ticks and
+# append one CSV row per replica to `path'.  grid maps parameter names
+# (see PARAMETERS) to lists of values.  Returns the whole file as a dict
+# of NumPy columns (parameters plus montecarlo.METRICS).
+def sweep(network_class, grid, steps, path, replicas=1, seed=0,
+          processes=None, interval=20, topology=make_topology):
+    unknown = set(grid).difference(name for name, default in PARAMETERS)
+    if unknown:
+        raise Exception, 'unknown sweep parameters %s' % sorted(unknown)
+    done = finished(path)
+    topologies = {}
+    jobs = []
+    for point in grid_points(grid):
+        key = tuple(point[name] for name in TOPOLOGY)
+        for i in range(replicas):
+            if point_key(point, i) in done: continue
+            if key not in topologies:
+                topo_seed = replica_seed(seed, hash(key) % 100003)
+                topologies[key] = topology(point['numnodes'],
+                                           point['threshold'], topo_seed)
+            factory = SweepFactory(network_class, topologies[key],
+                                   point['hello_interval'],
+                                   point['advert_interval'], steps)
+            spec = (factory, {'lossprob': point['lossprob']}, steps,
+                    replica_seed(seed, i), i, interval)
+            jobs.append((point, spec))
+
+    fields = [name for name, default in PARAMETERS] + list(METRICS)
+    new_file = not os.path.exists(path)
+    with open(path, 'ab') as f:
+        writer = csv.DictWriter(f, fields)
+        if new_file: writer.writeheader()
+        if processes == 1:
+            results = itertools.imap(run_point, jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(run_point, jobs)
+        try:
+            for point, metrics in results:
+                row = dict(point)
+                row.update(metrics)
+                writer.writerow(row)
+                f.flush()
+            if pool is not None: pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    return load(path)
+
+
+# read a results file back as a dict of NumPy columns
+def load(path):
+    with open(path, 'rb') as f:
+        rows = list(csv.DictReader(f))
+    result = {}
+    for name in rows[0].keys() if rows else []:
+        values = [row[name] for row in rows]
+        try:
+            result[name] = np.array([float(v) for v in values])
+        except ValueError:
+            result[name] = np.array(values)
+    return result
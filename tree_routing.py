@@ -1,27 +1,136 @@
 ### Tree routing protocol
+import heapq
 import numpy as np
+from collections import deque
 from matplotlib.lines import Line2D
 
 from dependency.set_up import *
 
 MEASUREMENT_INTERVAL = 5
 INTERVAL = 600
+SINKS = ('A', 'V')      # default sink addresses for TreeRouterNetwork
 
 
-def max_value_list(li, interval, time):
-    max_val = 0
-    output = None
-    for item in li:
-        if max_val < item[0] and item[1] >= time - interval:
-            max_val = item[0]
-            output = item
-    return output
+# Maximum of (value, time) measurements over a sliding time window.  A
+# monotonic deque keeps only the measurements that can still become the
+# maximum (values non-increasing from front to back), so push and max
+# are amortized O(1) however long the run.  max() is the earliest of the
+# largest unexpired values, or None if there is no positive one.
+class SlidingWindowMax:
+    def __init__(self, interval):
+        self.interval = interval
+        self.window = deque()
+
+    def __len__(self):
+        return len(self.window)
+
+    def push(self, value, time):
+        window = self.window
+        while window and window[-1][0] < value:
+            window.pop()
+        window.append((value, time))
+
+    def max(self, time):
+        window = self.window
+        while window and window[0][1] < time - self.interval:
+            window.popleft()
+        if window and window[0][0] > 0:
+            return window[0]
+        return None
+
+
+# Pollution table: a dict of address -> (value, timestamp) that also
+# keeps a max-heap on value and a min-heap on timestamp.  Superseded heap
+# entries are skipped lazily (each write bumps the address's version),
+# and the heaps are rebuilt when stale entries outnumber live ones, so
+# writes, expire() and argmax() are O(log n) amortized.  Write through
+# item assignment and del only.
+class PollutionTable(dict):
+    def __init__(self, entries=()):
+        dict.__init__(self)
+        self.version = {}       # address -> version of its live entry
+        self.seq = 0
+        self.by_value = []      # (-value, -seq, address)
+        self.by_time = []       # (timestamp, seq, address)
+        for ad, entry in dict(entries).items():
+            self[ad] = entry
+
+    def __setitem__(self, ad, entry):
+        dict.__setitem__(self, ad, entry)
+        self.seq += 1
+        self.version[ad] = self.seq
+        if entry is None:
+            return
+        heapq.heappush(self.by_value, (-entry[0], -self.seq, ad))
+        heapq.heappush(self.by_time, (entry[1], self.seq, ad))
+        if len(self.by_value) + len(self.by_time) > 4*len(self) + 16:
+            self.rebuild()
+
+    def __delitem__(self, ad):
+        dict.__delitem__(self, ad)
+        del self.version[ad]
+
+    def live(self, seq, ad):
+        return self.version.get(ad) == seq
+
+    # drop heap entries that no longer describe the table
+    def rebuild(self):
+        self.by_value = [e for e in self.by_value if self.live(-e[1], e[2])]
+        self.by_time = [e for e in self.by_time if self.live(e[1], e[2])]
+        heapq.heapify(self.by_value)
+        heapq.heapify(self.by_time)
+
+    # delete every entry stamped before cutoff, except address keep
+    def expire(self, cutoff, keep):
+        by_time = self.by_time
+        kept = []
+        while by_time and by_time[0][0] < cutoff:
+            entry = heapq.heappop(by_time)
+            if not self.live(entry[1], entry[2]):
+                continue
+            if entry[2] == keep:
+                kept.append(entry)
+            else:
+                del self[entry[2]]
+        for entry in kept:
+            heapq.heappush(by_time, entry)
+
+    # Address with the largest value, or None if no value is >= 0.  Ties
+    # go to the last of them in dict order, as max_value_dict_2 has it;
+    # only then is the table scanned.
+    def argmax(self):
+        by_value = self.by_value
+        while by_value and not self.live(-by_value[0][1], by_value[0][2]):
+            heapq.heappop(by_value)
+        if not by_value or by_value[0][0] > 0:
+            return None
+        if self.tied(by_value[0][0]):
+            return max_value_dict_2(self)
+        return by_value[0][2]
+
+    # True if more than one live entry has heap key key; equal keys form
+    # a subtree at the top of the heap
+    def tied(self, key):
+        by_value = self.by_value
+        count = 0
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if i >= len(by_value) or by_value[i][0] != key:
+                continue
+            if self.live(-by_value[i][1], by_value[i][2]):
+                count += 1
+                if count > 1: return True
+            stack.append(2*i + 1)
+            stack.append(2*i + 2)
+        return False
 
 
 def max_value_dict_2(dict):
     max_val = 0
     max_ad = None
     for item in dict.iteritems():
+        if item[1] is None: continue
         ad = item[0]
         val = item[1][0]
         if val >= max_val:
@@ -32,31 +141,46 @@ def max_value_dict_2(dict):
 
 
 class TreeRouter(Router):
-    def __init__(self, location, address=None):
+    def __init__(self, location, address=None, sink=False):
         Router.__init__(self, location, address=address)
-        if self.address == 'A' or self.address == 'V':
+        self.is_sink = sink
+        if sink:
             self.hopCount = 0 # Sink node with hop count 0
-            self.pollution = {}
+            self.pollution = PollutionTable()
+            self.root = self.address
         else:
             self.hopCount = sys.maxsize
-            self.pollution = {self.address: (0, 0)}
+            self.pollution = PollutionTable({self.address: (0, 0)})
+            self.root = None    # sink whose tree we have joined
         self.parent = None
+        self.parent_link = None     # cached Link to self.parent
+        self.parent_rebuilds = 0    # times parent_link was (re)cached
         self.trs_time = None
 
-        self.measurements = []
+        self.measurements = SlidingWindowMax(INTERVAL)
         self.local_max = None
 
     def send_pollution(self, time):
-        if self.address != 'A':
+        if not self.is_sink:
             data = self.make_data(time)
-            if data is not None:
-                for link in self.links:
-                        if link.end1.address == self.parent or link.end2.address == self.parent:
-                            # print('pollution of node {} is {}'.format(self.address, data))
-                            p = self.network.make_packet(self.address, self.peer(link),
-                                                         'DATA', time,
-                                                         color='red', ad=data)
-                            link.send(self, p)
+            link = self.uplink()
+            if data is not None and link is not None:
+                # print('pollution of node {} is {}'.format(self.address, data))
+                p = self.network.make_packet(self.address, self.peer(link),
+                                             'DATA', time,
+                                             color='red', ad=data)
+                link.send(self, p)
+
+    # link to our parent, looked up only when the cache is empty
+    def uplink(self):
+        if self.parent_link is None and self.parent is not None:
+            self.set_parent_link(self.getlink(self.parent))
+        return self.parent_link
+
+    def set_parent_link(self, link):
+        self.parent_link = link
+        if link is not None:
+            self.parent_rebuilds += 1
 
     def send_advertisement(self, time):
         adv = self.make_tree_advertisement()
@@ -68,43 +192,47 @@ class TreeRouter(Router):
 
     def make_data(self, time):
         measurement = np.random.randint(1000)
-        self.measurements.append((measurement, time))
-        self.local_max = max_value_list(self.measurements, INTERVAL, time)
+        self.measurements.push(measurement, time)
+        self.local_max = self.measurements.max(time)
         # print('At time {}, node {} has local max of {}'.format(time, self.address, self.local_max))
         # if self.local_max[0] > self.pollution[self.address][0]:
         self.pollution[self.address] = self.local_max
         # find the key with largest value
         # ad = max_value_dict(self.pollution, time, INTERVAL)
-        ad = max_value_dict_2(self.pollution)
+        ad = self.pollution.argmax()
         if ad is None:
             return ad
         else:
             return ad, self.pollution[ad]
 
     def dic_update(self, time, interval):
-        bad_ass = []
-        for item in self.pollution.iteritems():
-            ad = item[0]
-            timestemp = item[1][1]
-            # if val >= max_val:
-            if timestemp < time - interval - MEASUREMENT_INTERVAL and ad is not self.address:
-                bad_ass.append(ad)
-        for ad in bad_ass:
-            # print('deleting {} in node {}'.format(self.pollution[ad], self.address))
-            del self.pollution[ad]
+        # drop other nodes' readings that are too old to matter
+        self.pollution.expire(time - interval - MEASUREMENT_INTERVAL,
+                              self.address)
 
             # Make a distance vector protocol advertisement, which will be sent
     # by the caller along all the links
     def make_tree_advertisement(self):
         # nodeHopCount = beaconHopCount + 1
-        return (self.address, self.hopCount)
+        return (self.address, self.hopCount, self.root)
+
+    # ticks between sending an ADVERT and its arrival on a link we don't
+    # send DATA on: one, plus one if a HELLO packet goes out ahead of it
+    def advert_delay(self):
+        if getattr(self.network, 'hello_engine', None) is None and \
+           self.ADVERT_INTERVAL % self.HELLO_INTERVAL == 0 and \
+           self.ad_offset % self.HELLO_INTERVAL == self.hello_offset:
+            return 2
+        return 1
 
     def link_failed(self, link):
         # If a link is broken, remove it from my routing/cost table
         self.clear_routes(self)
+        if link is self.parent_link:
+            self.set_parent_link(None)
 
     def process_advertisement(self, p, link, time):
-        self.integrate(p.properties['ad'], p.start, time)
+        self.integrate(p.properties['ad'], p.start, time, link)
 
     def process_data(self, p, time):
         data = p.properties['ad']
@@ -112,25 +240,99 @@ class TreeRouter(Router):
         self.dic_update(time, INTERVAL)
 
     # Integrate new routing advertisement to update routing
-    # table and costs
-    def integrate(self, adv, t_send, t_rece):
+    # table and costs.  link, if known, is the one adv arrived on.
+    def integrate(self, adv, t_send, t_rece, link=None):
         # Update purse hopCount and associate it with its parent
         dst = adv[0]
         dst_cost = adv[1]
         if dst_cost + 1 < self.hopCount:
-            self.parent = dst
+            self.change_parent(dst, link)
             self.hopCount = dst_cost + 1
             self.trs_time = t_rece - t_send
+            self.root = adv[2]
         elif dst_cost+1 == self.hopCount and (t_rece - t_send) < self.trs_time:
-            self.parent = dst # same hop number, but less transmission time, change parent only
+            self.change_parent(dst, link) # same hop number, but less transmission time, change parent only
             self.trs_time = t_rece - t_send
+            self.root = adv[2]
+        elif dst == self.parent:
+            # our parent may have moved to another sink's tree
+            self.root = adv[2]
+
+    def change_parent(self, parent, link=None):
+        if parent != self.parent:
+            self.parent = parent
+            # without the link, uplink() finds it on the next send
+            self.set_parent_link(link)
+        elif link is not None and link is not self.parent_link:
+            self.set_parent_link(link)
 
 
 # A network with nodes of type DVRouter.
+#
+# sinks is the set of addresses that collect data (addresses missing from
+# NODES are ignored); every other node joins the tree of the sink fewest
+# hops away (TreeRouter.root).  With
+# warm_start=True, reset() installs the collection trees that ADVERT
+# exchange settles on (see build_tree) so runs start in steady state.
 class TreeRouterNetwork(RouterNetwork):
+    def __init__(self, SIMTIME, NODES, LINKS, LOSSPROB, sinks=SINKS,
+                 warm_start=False, **options):
+        self.sinks = frozenset(sinks)   # needed by make_node
+        self.warm_start = warm_start
+        RouterNetwork.__init__(self, SIMTIME, NODES, LINKS, LOSSPROB, **options)
+
     # nodes should be an instance of DVNode (defined above)
     def make_node(self,loc,address=None):
-        return TreeRouter(loc,address=address)
+        return TreeRouter(loc,address=address,sink=address in self.sinks)
+
+    def sink_nodes(self):
+        return [n for n in self.nlist if n.is_sink]
+
+    def reset(self):
+        RouterNetwork.reset(self)
+        if self.warm_start:
+            self.build_tree()
+
+    # Multi-sink BFS over working links, giving every node the hopCount,
+    # parent, root and trs_time it converges to on lossless links.  The
+    # trees of all sinks grow together, one hop per layer, so each node
+    # lands in the tree of its nearest sink.  All routers
+    # advertise on the same tick, so a node hears every neighbour one hop
+    # closer to a sink at once, with the same delay, and keeps the first
+    # one processed: the first such neighbour in its link order.
+    def build_tree(self):
+        layer = []
+        for n in self.nlist:
+            n.parent = None
+            n.set_parent_link(None)
+            n.trs_time = None
+            if n.is_sink:
+                n.hopCount = 0
+                layer.append(n)   # sinks are the roots
+            else:
+                n.hopCount = sys.maxsize
+                n.root = None
+        hop = 0
+        while layer:
+            hop += 1
+            candidates = []
+            for n in layer:
+                for link in n.links:
+                    other = link.end2 if link.end1 is n else link.end1
+                    if not link.broken and other.hopCount > hop:
+                        candidates.append(other)
+            layer = []
+            for n in candidates:
+                if n.hopCount <= hop: continue   # already placed
+                for link in n.links:
+                    other = link.end2 if link.end1 is n else link.end1
+                    if not link.broken and other.hopCount == hop - 1:
+                        n.hopCount = hop
+                        n.change_parent(other.address, link)
+                        n.trs_time = other.advert_delay()
+                        n.root = other.root
+                        layer.append(n)
+                        break
 
 
 def make_proxy(color, **kwargs):
@@ -147,7 +349,7 @@ def show_tree(net):
     for i in range(net.numnodes):
         node = net.nlist[i]
         (x, y) = node.location
-        if i == 0 or i == 21:
+        if node.is_sink:
             plt.scatter(x, y, s=350, facecolors='none', marker='s',
                         edgecolors='#EE9A00', linewidths=2)
             plt.text(x - 0.3, y - 0.38, node.address, fontsize=14)
@@ -162,16 +364,15 @@ def show_tree(net):
         # Creating line obj bwtween parent and children
         line = [(x, y), (px, py)]
         lines.append(line)
-        colors.append(color_sink[node.hopCount-1])
+        colors.append(color_sink[(node.hopCount-1) % len(color_sink)])
         if node.hopCount > max_hop:
             max_hop = node.hopCount
 
     lc = mc.LineCollection(lines, colors=colors, linewidths=2)
     ax.add_collection(lc)
-    z = color_sink[:max_hop]
+    z = color_sink[:min(max_hop, len(color_sink))]
     proxies = [make_proxy(item, linewidth=5) for item in z]
-    ax.legend(proxies, ['HopCount = 1', 'HopCount = 2', 'HopCount = 3', 'HopCount = 4',
-                        'HopCount = 5', 'HopCount = 6'])
+    ax.legend(proxies, ['HopCount = %d' % (h + 1) for h in range(len(z))])
     plt.show()
 
 